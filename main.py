@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import os
-import asyncio
 topdir = os.path.dirname(os.path.abspath(__file__))
 
 # tmpl_dir = os.path.join(topdir, 'tmpl')
@@ -59,7 +58,7 @@ def main():
   tornado.options.parse_command_line()
   application = MyApp(
     routers,
-    gzip = True,
+    # feeds are compressed once when cached, see morerss.cache
     debug = options.debug,
     # template_path = tmpl_dir,
     # cookie_secret = settings['cookie_secret'],
@@ -67,8 +66,12 @@ def main():
   http_server = HTTPServer(application, xheaders=True)
   http_server.listen(options.port, address=options.address)
 
-  from morerss.zhihu import _article_fetcher
-  asyncio.ensure_future(_article_fetcher())
+  from morerss.render import get_executor
+  get_executor()
+  from morerss.zhihu_store import get_store
+  get_store()
+  from morerss.zhihu_fetcher import get_fetcher
+  get_fetcher().start()
   tornado.ioloop.IOLoop.instance().start()
 
 if __name__ == "__main__":
@@ -1,10 +1,3 @@
-from tornado.httpclient import AsyncHTTPClient
-try:
-  import pycurl
-  AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-except ImportError:
-  pycurl = None
-
 from .jike import JikeUserHandler
 from .jike import JikeTopicHandler
 from .matters import MattersCircleHandler
@@ -1,18 +1,81 @@
+import io
 import traceback
 import http.client
-from urllib.parse import quote
+from urllib.parse import quote, urlencode
 import logging
 import datetime
+import asyncio
+import hashlib
+import time
+from functools import partial
+from email.utils import parsedate_to_datetime
+from xml.sax import saxutils
 
-from tornado import web, httpclient
+from tornado import web, httpclient, httputil, iostream
+from tornado.options import options
 from tornado.log import gen_log
 import PyRSS2Gen
 import statsd
 
+from . import cache
+
 __version__ = '0.4'
 logger = logging.getLogger(__name__)
 STATSC = statsd.StatsClient('localhost', 8125, prefix='morerss')
 
+# cache key -> Future of the render in progress for it
+_renders = {}
+# seconds between attempts to refresh a feed whose upstream is failing
+_STALE_RETRY = 300
+# cache key -> (ETag of the feed, when this process first saw it)
+_etag_seen = cache.LRUCache(4 * 1024 * 1024)
+# seconds to remember an ETag for; a feed not polled for longer gets a new
+# Last-Modified, which only costs a full response
+_ETAG_SEEN_TTL = 7 * 86400
+
+def _render_done(key, fut):
+  if _renders.get(key) is fut:
+    del _renders[key]
+
+def _log_background_render(fut):
+  if not fut.cancelled() and fut.exception() is not None:
+    logger.warning('error refreshing feed: %s', fut.exception())
+
+def _is_upstream_error(e):
+  '''Whether a render failure may be temporary, so a stale copy will do'''
+  if isinstance(e, web.HTTPError):
+    return e.status_code >= 500
+  elif isinstance(e, httpclient.HTTPClientError):
+    return e.code >= 500
+  return True
+
+async def gather(*aws):
+  '''Run independent upstream calls concurrently, like asyncio.gather.
+
+  If one of them fails, the rest are cancelled before the error propagates,
+  so that no request outlives the render that started it.
+  '''
+  tasks = [asyncio.ensure_future(aw) for aw in aws]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    raise
+
+def discard(task):
+  '''Cancel *task* whose result turned out not to be needed'''
+  if not task.done():
+    task.cancel()
+  elif not task.cancelled():
+    # mark the exception retrieved, if any
+    task.exception()
+
+class _DetachedConnection:
+  '''Stands in for the HTTP connection of a handler rendering in background.'''
+  def set_close_callback(self, callback):
+    pass
+
 class BaseHandler(web.RequestHandler):
   error_page = '''\
 <!DOCTYPE html>
@@ -26,9 +89,323 @@ class BaseHandler(web.RequestHandler):
 <hr/>
 '''
 
+  # seconds to keep a rendered feed in the server-side cache;
+  # None means --feed-cache-ttl, 0 disables caching for the route
+  cache_ttl = None
+  # query arguments that select a different feed on the same path
+  cache_args = ()
+  # response headers not worth replaying from the cache
+  _uncached_headers = {'Date', 'Server', 'Content-Length'}
+
+  # set on the copy of a handler that renders a feed for shared use
+  _detached = False
+  # the request a detached handler streams the feed to, if any
+  _leader = None
+  # set on the request a feed is being streamed to by a detached handler
+  _streamed = False
+  # characters of a feed to send to the client at a time
+  feed_flush_size = 64 * 1024
+
   def initialize(self):
     self.set_header('Content-Type', 'application/rss+xml; charset=utf-8')
     self.set_header('Cache-Control', 'public, max-age=14400')
+    self._cache_key = None
+    self._previous = None
+    self._rendered = None
+
+  def get_cache_ttl(self):
+    if self.cache_ttl is None:
+      return options.feed_cache_ttl
+    return self.cache_ttl
+
+  def cache_key(self):
+    args = []
+    for name in sorted(self.cache_args):
+      value = self.get_argument(name, None)
+      if value is not None:
+        args.append((name, value))
+    return '%s:%s?%s' % (
+      self.__class__.__name__, '/'.join(self.path_args), urlencode(args))
+
+  async def prepare(self):
+    if self._detached or self.request.method != 'GET' \
+       or not self.get_cache_ttl():
+      return
+
+    key = self.cache_key()
+    feed_cache = cache.get_feed_cache()
+    feed = feed_cache.get(key)
+    now = time.time()
+    if feed is not None and now < feed.expires:
+      STATSC.incr('feed_cache.hit')
+    elif feed is not None and feed_cache.is_stale_usable(feed, now):
+      STATSC.incr('feed_cache.stale')
+      if key not in _renders:
+        fut = self._start_render(key, feed)
+        fut.add_done_callback(_log_background_render)
+    else:
+      STATSC.incr('feed_cache.miss')
+      fut = _renders.get(key)
+      if fut is None:
+        # with no stale copy to fall back to, this request may as well
+        # get the feed as it's rendered
+        fut = self._start_render(key, feed, leader=feed is None)
+      else:
+        STATSC.incr('feed_cache.coalesced')
+      try:
+        feed = await asyncio.shield(fut)
+      except Exception:
+        if self._headers_written:
+          # don't let a cut-off feed pass for a whole one
+          self.request.connection.close()
+        raise
+      if self._streamed:
+        self.finish()
+        return
+
+    self.set_status(feed.status, feed.reason)
+    for k, v in feed.headers:
+      self.set_header(k, v)
+    if feed.status == 200 and self.check_not_modified():
+      self.set_status(304)
+      self.finish()
+      return
+
+    body = feed.body
+    if feed.encoded:
+      self.set_header('Vary', 'Accept-Encoding')
+      encoding, body = feed.negotiate(
+        self.request.headers.get('Accept-Encoding', ''))
+      if encoding:
+        self.set_header('Content-Encoding', encoding)
+    self.finish(body)
+
+  def _start_render(self, key, previous, leader=False):
+    '''Render the feed once for all concurrent requests of the same key.
+
+    The render runs in a detached copy of this handler so that it doesn't
+    depend on any one client staying connected. Every waiter of the returned
+    future receives the same response, or the exception the render failed
+    with.
+
+    *previous* is the expired copy of the feed, if any. The render reuses it
+    when the upstream items turn out unchanged, and falls back to it when
+    the upstream fails.
+
+    With *leader*, a feed finished with finish_feed() is also sent to this
+    request as it's rendered; the future's result is then only for the
+    other waiters.
+    '''
+    handler = self._detached_copy(key)
+    handler._previous = previous
+    if leader:
+      handler._leader = self
+    fut = asyncio.ensure_future(handler._render())
+    _renders[key] = fut
+    fut.add_done_callback(partial(_render_done, key))
+    return fut
+
+  def _detached_copy(self, key):
+    req = self.request
+    request = httputil.HTTPServerRequest(
+      method = req.method,
+      uri = req.uri,
+      version = req.version,
+      headers = req.headers,
+      host = req.host,
+      connection = _DetachedConnection(),
+    )
+    handler = self.__class__(self.application, request)
+    handler._detached = True
+    handler._cache_key = key
+    handler.path_args = self.path_args
+    handler.path_kwargs = self.path_kwargs
+    return handler
+
+  async def _render(self):
+    method = getattr(self, self.request.method.lower())
+    try:
+      result = method(*self.path_args, **self.path_kwargs)
+      if result is not None:
+        await result
+    except Exception as e:
+      if not _is_upstream_error(e):
+        raise
+      feed = self._stale_if_error(e)
+      if feed is None:
+        raise
+      return feed
+
+    feed = self._rendered
+    if feed is None:
+      raise RuntimeError('%s did not finish the response'
+                         % self.__class__.__name__)
+    if feed.status >= 500:
+      feed = self._stale_if_error(feed.status) or feed
+    return feed
+
+  def _stale_if_error(self, error):
+    previous = self._previous
+    if previous is None or time.time() >= previous.error_until:
+      return None
+
+    logger.warning('serving stale %s: %s', self._cache_key, error)
+    STATSC.incr('feed_cache.stale_if_error')
+    # don't retry the upstream for every request while it's failing
+    retry = min(self.get_cache_ttl(), _STALE_RETRY)
+    cache.get_feed_cache().retry_later(self._cache_key, previous, retry)
+    return previous
+
+  def not_modified(self, validators):
+    '''Set the ETag and Last-Modified of the feed before rendering it.
+
+    *validators* identify the upstream items the feed is built from, e.g.
+    post ids with their update times.
+
+    Last-Modified is when this process first saw the ETag. The newest
+    upstream timestamp won't do, as items are deleted, or full texts saved,
+    without it changing. Processes that saw the ETag later send a later
+    time, so an If-Modified-Since answered by another one is never wrongly
+    taken as current.
+
+    Returns True if the response has been finished because the client, or
+    the expired cached copy being refreshed, already has this version. The
+    caller should return without rendering then.
+    '''
+    h = hashlib.sha1(__version__.encode())
+    for v in validators:
+      h.update(repr(v).encode('utf-8'))
+    etag = 'W/"%s"' % h.hexdigest()
+    self.set_header('Etag', etag)
+
+    key = self._cache_key or self.cache_key()
+    seen = _etag_seen.get(key)
+    if seen is None or seen[0] != etag:
+      now = time.time()
+      if seen is not None:
+        # Last-Modified has whole seconds only
+        now = max(now, seen[1] + 1)
+      seen = etag, now
+      _etag_seen.set(key, seen, len(key) + 128, _ETAG_SEEN_TTL)
+    self.set_header('Last-Modified', httputil.format_timestamp(seen[1]))
+
+    if self._detached:
+      previous = self._previous
+      if previous is None or previous.status != 200 \
+         or previous.header('Etag') != self._headers['Etag']:
+        return False
+      STATSC.incr('feed_cache.revalidated')
+      self.finish(previous.body)
+      return True
+
+    if self.check_not_modified():
+      self.set_status(304)
+      self.finish()
+      return True
+    return False
+
+  def check_not_modified(self):
+    '''Check the conditional request headers against the response ones'''
+    if 'If-None-Match' in self.request.headers:
+      return self.check_etag_header()
+
+    since = self.request.headers.get('If-Modified-Since')
+    modified = self._headers.get('Last-Modified')
+    if not since or not modified:
+      return False
+    try:
+      return parsedate_to_datetime(since) >= parsedate_to_datetime(modified)
+    except (TypeError, ValueError):
+      return False
+
+  def finish(self, chunk=None):
+    if not self._detached:
+      return super().finish(chunk)
+
+    if self._finished:
+      raise RuntimeError("finish() called twice")
+    if chunk is not None:
+      self.write(chunk)
+    headers = [(k, v) for k, v in self._headers.get_all()
+               if k not in self._uncached_headers]
+    feed = self._rendered = cache.CachedFeed(
+      b''.join(self._write_buffer), headers,
+      self.get_status(), self._reason,
+    )
+    self._finished = True
+
+    if feed.status == 200:
+      previous = self._previous
+      if previous is not None and previous.body == feed.body:
+        feed.encoded = previous.encoded
+      else:
+        feed.compress()
+      cache.get_feed_cache().put(self._cache_key, feed, self.get_cache_ttl())
+
+    fut = asyncio.Future()
+    fut.set_result(None)
+    return fut
+
+  async def finish_feed(self, chunks):
+    '''Finish with a feed given in chunks of XML, e.g. by render.feed()
+
+    The chunks are sent to the client as they are made. A feed rendered
+    for the cache is kept whole for it, and sent as it's made only to the
+    request that started the render on a cold miss: the others get it
+    compressed from the cache, and with a stale copy there an upstream
+    error must not have sent anything yet.
+    '''
+    self._stream = self._stream_to()
+    self._unflushed = 0
+    try:
+      if hasattr(chunks, '__aiter__'):
+        async for chunk in chunks:
+          await self._feed_chunk(chunk)
+      else:
+        for chunk in chunks:
+          await self._feed_chunk(chunk)
+    finally:
+      if hasattr(chunks, 'aclose'):
+        await chunks.aclose()
+    self.finish()
+
+  def _stream_to(self):
+    '''The handler to send a feed to as it's made, if any'''
+    if not self._detached:
+      return self
+    leader = self._leader
+    if leader is None or leader._finished:
+      return None
+
+    leader.set_status(self.get_status(), self._reason)
+    for k, v in self._headers.get_all():
+      if k not in self._uncached_headers:
+        leader.set_header(k, v)
+    if self.get_status() != 200 or leader.check_not_modified():
+      # answered from the render's result
+      return None
+    leader._streamed = True
+    STATSC.incr('feed_cache.streamed')
+    return leader
+
+  async def _feed_chunk(self, chunk):
+    self.write(chunk)
+    to = self._stream
+    if to is None:
+      return
+    if to is not self:
+      to.write(chunk)
+    self._unflushed += len(chunk)
+    if self._unflushed >= self.feed_flush_size:
+      self._unflushed = 0
+      if to is self:
+        await self.flush()
+        return
+      try:
+        await to.flush()
+      except iostream.StreamClosedError:
+        # the client went away; the feed is still rendered for the cache
+        self._stream = None
 
   def write_error(self, status_code, **kwargs):
     if self.settings.get("debug") and "exc_info" in kwargs:
@@ -66,8 +443,43 @@ class BaseHandler(web.RequestHandler):
     else:
       super().log_exception(typ, value, tb)
 
-def data2rss(url, info, data, transform_func):
-  items = [transform_func(x) for x in data]
+# what PyRSS2Gen ends a feed with, after the items
+RSS_END = '</channel></rss>'
+
+def rss_chunks(url, info, data, transform_func=None):
+  '''Like data2rss(...).to_xml(encoding='utf-8'), but in chunks
+
+  The channel is yielded first, then each item as soon as it's made, so
+  that the whole feed is never held at once. The chunks join into exactly
+  what to_xml() would give.
+  '''
+  yield rss_head(url, info)
+  for x in data:
+    xml = item_xml(x, transform_func)
+    if xml:
+      yield xml
+  yield RSS_END
+
+def rss_head(url, info):
+  '''The XML of a feed before its items; they end with RSS_END'''
+  head = data2rss(url, info, ()).to_xml(encoding='utf-8')
+  return head[:-len(RSS_END)]
+
+def item_xml(x, transform_func=None):
+  '''The XML of the item *x* is turned into, or '' if it's left out'''
+  item = x if transform_func is None else transform_func(x)
+  if not item:
+    return ''
+  f = io.StringIO()
+  item.publish(saxutils.XMLGenerator(f, 'utf-8'))
+  return f.getvalue()
+
+def data2rss(url, info, data, transform_func=None):
+  '''*data* are turned into RSSItems by *transform_func*, if not already'''
+  if transform_func is None:
+    items = list(data)
+  else:
+    items = [transform_func(x) for x in data]
   items = [x for x in items if x]
   rss = PyRSS2Gen.RSS2(
     title = info['title'],
@@ -97,13 +509,6 @@ PIC_PROXIES = {
   'cf': _proxify_url_cf,
 }
 
-def proxify_pic(doc, pattern, pic):
-  p = PIC_PROXIES[pic]
-  for img in doc.xpath('//img[@src]'):
-    src = img.get('src')
-    if pattern.match(src):
-      img.set('src', p(src))
-
 class MyApp(web.Application):
   def log_request(self, handler):
     super().log_request(handler)
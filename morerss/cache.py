@@ -0,0 +1,374 @@
+import os
+import time
+import random
+import gzip
+import pickle
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+
+from tornado.options import options, define
+try:
+  import brotli
+except ImportError:
+  brotli = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+define("cache-dir", default='/tmp/rss-cache',
+       help="cache directory for RSS data", type=str)
+define("feed-cache-backend", default='memory',
+       help="where to keep rendered feeds: memory, sqlite or disk "
+            "(the latter two under --cache-dir)", type=str)
+define("feed-cache-ttl", default=1800,
+       help="seconds to keep rendered feeds, 0 to disable", type=int)
+define("feed-cache-size", default=64,
+       help="maximum size of the rendered feed cache in MiB", type=int)
+define("feed-cache-jitter", default=0.1,
+       help="randomize feed TTLs by this fraction", type=float)
+define("feed-cache-stale", default=3600,
+       help="seconds after expiry to serve a feed while refreshing it in background", type=int)
+define("feed-cache-stale-if-error", default=86400,
+       help="seconds after expiry to serve a feed while the upstream fails", type=int)
+
+logger = logging.getLogger(__name__)
+
+# not worth the Content-Encoding header and compression framing below this
+MIN_COMPRESS_LENGTH = 1024
+
+class CacheBackend:
+  '''Storage of cache entries with per-entry expiry and a size cap.
+
+  Values are opaque to the backend; those not kept in memory are pickled.
+  '''
+  def get(self, key):
+    '''Return the value for *key*, or None if missing or expired'''
+    raise NotImplementedError
+
+  def set(self, key, value, size, ttl):
+    '''Store *value* of about *size* bytes for *ttl* seconds'''
+    raise NotImplementedError
+
+  def delete(self, key):
+    raise NotImplementedError
+
+class LRUCache(CacheBackend):
+  '''An in-memory cache with a cap on the total size in bytes.
+
+  Least recently used entries are evicted first when the cap is exceeded.
+  '''
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._data = OrderedDict()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key):
+    try:
+      value, size, expires = self._data[key]
+    except KeyError:
+      return None
+
+    if expires < time.time():
+      self.delete(key)
+      return None
+
+    self._data.move_to_end(key)
+    return value
+
+  def set(self, key, value, size, ttl):
+    self.delete(key)
+    if size > self.max_bytes:
+      return
+
+    self._data[key] = value, size, time.time() + ttl
+    self.size += size
+    while self.size > self.max_bytes:
+      _, (_, old_size, _) = self._data.popitem(last=False)
+      self.size -= old_size
+
+  def delete(self, key):
+    try:
+      _, size, _ = self._data.pop(key)
+    except KeyError:
+      return
+    self.size -= size
+
+class SQLiteCache(CacheBackend):
+  '''A cache in an SQLite database, which survives restarts and can be
+  shared by several processes.
+
+  Least recently used entries are evicted first when the cap is exceeded.
+  '''
+  # check the total size every this many sets
+  check_every = 100
+
+  def __init__(self, path, max_bytes):
+    self.max_bytes = max_bytes
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self._db = sqlite3.connect(path, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS cache (
+      key TEXT PRIMARY KEY,
+      value BLOB NOT NULL,
+      size INTEGER NOT NULL,
+      expires REAL NOT NULL,
+      accessed REAL NOT NULL
+    )''')
+    self._db.execute(
+      'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+    self._sets = 0
+    self._evict()
+
+  def get(self, key):
+    now = time.time()
+    row = self._db.execute(
+      'SELECT value FROM cache WHERE key = ? AND expires >= ?', (key, now),
+    ).fetchone()
+    if row is None:
+      return None
+    self._db.execute(
+      'UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+    return pickle.loads(row[0])
+
+  def set(self, key, value, size, ttl):
+    if size > self.max_bytes:
+      self.delete(key)
+      return
+
+    now = time.time()
+    self._db.execute(
+      'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+      (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), size, now + ttl, now),
+    )
+    self._sets += 1
+    if self._sets % self.check_every == 0:
+      self._evict()
+
+  def delete(self, key):
+    self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+  def _evict(self):
+    db = self._db
+    db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+    if total <= self.max_bytes:
+      return
+
+    db.execute('BEGIN')
+    for key, size in db.execute(
+      'SELECT key, size FROM cache ORDER BY accessed').fetchall():
+      db.execute('DELETE FROM cache WHERE key = ?', (key,))
+      total -= size
+      if total <= self.max_bytes:
+        break
+    db.execute('COMMIT')
+
+class DiskCache(CacheBackend):
+  '''A cache with one file per entry, which survives restarts.
+
+  The oldest entries by modification time are evicted first when the cap
+  is exceeded.
+  '''
+  # check the total size every this many sets
+  check_every = 100
+
+  def __init__(self, path, max_bytes):
+    self.path = path
+    self.max_bytes = max_bytes
+    os.makedirs(path, exist_ok=True)
+    self._sets = 0
+    self._evict()
+
+  def _path(self, key):
+    h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(self.path, h[:2], h[2:])
+
+  def get(self, key):
+    try:
+      with open(self._path(key), 'rb') as f:
+        stored_key, expires, value = pickle.load(f)
+    except FileNotFoundError:
+      return None
+    except Exception:
+      logger.exception('bad cache file for %s', key)
+      self.delete(key)
+      return None
+
+    if stored_key != key or expires < time.time():
+      return None
+    return value
+
+  def set(self, key, value, size, ttl):
+    if size > self.max_bytes:
+      self.delete(key)
+      return
+
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+      pickle.dump((key, time.time() + ttl, value), f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+    self._sets += 1
+    if self._sets % self.check_every == 0:
+      self._evict()
+
+  def delete(self, key):
+    try:
+      os.unlink(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  def _evict(self):
+    files = []
+    for d in os.scandir(self.path):
+      if d.is_dir():
+        for f in os.scandir(d.path):
+          st = f.stat()
+          files.append((st.st_mtime, st.st_size, f.path))
+
+    total = sum(size for _, size, _ in files)
+    if total <= self.max_bytes:
+      return
+    files.sort()
+    for _, size, path in files:
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      if total <= self.max_bytes:
+        break
+
+class CachedFeed:
+  '''A finished response body together with the status and headers to replay.
+
+  *expires* is when the feed should be rendered again, and *error_until*
+  how long it may still be served if that fails.
+  '''
+  __slots__ = ('body', 'headers', 'status', 'reason', 'expires', 'error_until',
+               'encoded')
+
+  def __init__(self, body, headers, status=200, reason=None):
+    self.body = body
+    self.headers = headers
+    self.status = status
+    self.reason = reason
+    self.expires = self.error_until = 0
+    # Content-Encoding -> compressed body
+    self.encoded = {}
+
+  def compress(self):
+    '''Compress the body once with each available content coding'''
+    if len(self.body) < MIN_COMPRESS_LENGTH:
+      return
+    self.encoded['gzip'] = gzip.compress(self.body, compresslevel=6, mtime=0)
+    if brotli:
+      self.encoded['br'] = brotli.compress(self.body, quality=5)
+    if zstandard:
+      self.encoded['zstd'] = zstandard.ZstdCompressor(level=9).compress(self.body)
+
+  def negotiate(self, accept_encoding):
+    '''Pick the smallest variant acceptable to the client
+
+    Returns the Content-Encoding (or None for identity) and the body.
+    '''
+    accepted = _parse_accept_encoding(accept_encoding)
+    best = None
+    for coding, body in self.encoded.items():
+      q = accepted.get(coding, accepted.get('*', 0))
+      if q > 0 and (best is None or len(body) < len(self.encoded[best])):
+        best = coding
+    if best is None:
+      return None, self.body
+    return best, self.encoded[best]
+
+  def header(self, name):
+    for k, v in self.headers:
+      if k == name:
+        return v
+    return None
+
+  @property
+  def size(self):
+    return len(self.body) + sum(map(len, self.encoded.values())) \
+        + sum(len(k) + len(v) for k, v in self.headers)
+
+def _parse_accept_encoding(value):
+  accepted = {}
+  for part in value.split(','):
+    coding, _, params = part.partition(';')
+    coding = coding.strip().lower()
+    if not coding:
+      continue
+    q = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        q = float(params[2:])
+      except ValueError:
+        pass
+    accepted[coding] = q
+  return accepted
+
+class FeedCache:
+  '''Rendered feeds, kept past their TTL for stale serving.'''
+  def __init__(self, backend):
+    self._backend = backend
+
+  def get(self, key):
+    return self._backend.get(key)
+
+  def put(self, key, feed, ttl):
+    '''Store a freshly rendered *feed* for about *ttl* seconds.
+
+    The TTL is jittered so that feeds rendered together don't all expire
+    and hit the upstream together.
+    '''
+    jitter = options.feed_cache_jitter
+    ttl *= random.uniform(1 - jitter, 1 + jitter)
+    now = time.time()
+    feed.expires = now + ttl
+    feed.error_until = feed.expires + options.feed_cache_stale_if_error
+    self._store(key, feed, now)
+
+  def retry_later(self, key, feed, delay):
+    '''Keep serving *feed* after a failed render, retrying after *delay*'''
+    now = time.time()
+    feed.expires = min(now + delay, feed.error_until)
+    self._store(key, feed, now)
+
+  def is_stale_usable(self, feed, now):
+    '''Whether an expired *feed* can be served while it's being refreshed'''
+    return now < feed.expires + options.feed_cache_stale
+
+  def _store(self, key, feed, now):
+    keep_until = max(feed.expires + options.feed_cache_stale, feed.error_until)
+    self._backend.set(key, feed, feed.size, keep_until - now)
+
+_feed_cache = None
+
+def get_feed_cache():
+  global _feed_cache
+  if _feed_cache is None:
+    max_bytes = options.feed_cache_size * 1024 * 1024
+    kind = options.feed_cache_backend
+    if kind == 'memory':
+      backend = LRUCache(max_bytes)
+    elif kind == 'sqlite':
+      backend = SQLiteCache(
+        os.path.join(options.cache_dir, 'feeds.sqlite3'), max_bytes)
+    elif kind == 'disk':
+      backend = DiskCache(os.path.join(options.cache_dir, 'feeds'), max_bytes)
+    else:
+      raise ValueError('unknown feed cache backend: %r' % kind)
+    _feed_cache = FeedCache(backend)
+  return _feed_cache
@@ -0,0 +1,88 @@
+'''Reading the JSON data pages embed in <script> elements.
+
+Zhihu and Jike pages carry the data they are rendered from as JSON in a
+<script> element. Parsing the whole page into an lxml tree only to read
+that element costs more than everything else done for a request, so the
+raw bytes are scanned for the element instead, and only its content is
+decoded. Markup the scan doesn't understand falls back to lxml.
+
+Run this module with recorded pages to compare both ways:
+
+  python -m morerss.embedded id=js-initialData page.html ...
+'''
+
+import re
+import json
+import logging
+
+from lxml.html import fromstring
+
+from . import base
+
+logger = logging.getLogger(__name__)
+
+# (attr, value) -> compiled start tag pattern
+_patterns = {}
+
+def _pattern(attr, value):
+  key = attr, value
+  pattern = _patterns.get(key)
+  if pattern is None:
+    a = re.escape(attr.encode())
+    v = re.escape(value.encode())
+    pattern = _patterns[key] = re.compile(
+      rb'<script\s(?:[^>]*?\s)?%s\s*=\s*(?:"%s"|\'%s\'|%s(?=[\s/>]))[^>]*>'
+      % (a, v, v, v), re.I)
+  return pattern
+
+def script_json(body, attr, value):
+  '''Decode the JSON in the first <script> element whose *attr* is *value*
+
+  *body* is the page as bytes. Raises ValueError if there is no such
+  element or it doesn't hold JSON.
+  '''
+  m = _pattern(attr, value).search(body)
+  if m:
+    end = body.find(b'</script', m.end())
+    if end != -1:
+      try:
+        return json.loads(body[m.end():end])
+      except ValueError:
+        pass
+
+  base.STATSC.incr('embedded.fallback')
+  logger.debug('no <script %s="%s"> found by scanning, parsing the page',
+               attr, value)
+  return _lxml_script_json(body, attr, value)
+
+def _lxml_script_json(body, attr, value):
+  doc = fromstring(body)
+  scripts = doc.xpath('//script[@%s=$value]' % attr, value=value)
+  if not scripts:
+    raise ValueError('no <script %s="%s"> in page' % (attr, value))
+  return json.loads(scripts[0].text_content())
+
+def _benchmark(attr, value, paths, number=100):
+  import timeit
+
+  for path in paths:
+    with open(path, 'rb') as f:
+      body = f.read()
+
+    assert script_json(body, attr, value) \
+        == _lxml_script_json(body, attr, value), path
+    scan = timeit.timeit(
+      lambda: script_json(body, attr, value), number=number)
+    parse = timeit.timeit(
+      lambda: _lxml_script_json(body, attr, value), number=number)
+    print('%s (%d KiB): scan %.3fms, lxml %.3fms, %.1fx' % (
+      path, len(body) // 1024,
+      scan / number * 1000, parse / number * 1000, parse / scan))
+
+if __name__ == '__main__':
+  import sys
+
+  if len(sys.argv) < 3:
+    sys.exit('usage: python -m morerss.embedded ATTR=VALUE PAGE...')
+  attr, value = sys.argv[1].split('=', 1)
+  _benchmark(attr, value, sys.argv[2:])
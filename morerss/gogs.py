@@ -1,47 +1,54 @@
 import datetime
 
 import PyRSS2Gen
-from tornado import web
-from tornado.httpclient import AsyncHTTPClient
 from lxml.html import fromstring, tostring
 
 from .base import BaseHandler
-from . import base
+from . import upstream, render
 
-httpclient = AsyncHTTPClient()
+# gogs runs on whatever hosts users ask for
+site = upstream.Site('gogs', per_host=True)
 
 class GogsIssueHandler(BaseHandler):
+  cache_ttl = 600
+
   async def get(self, host, user, repo, nr):
     url = f'https://{host}/{user}/{repo}/issues/{nr}'
-    webpage = await self._get_url(url)
+    webpage = await site.get_text(url)
 
-    doc = fromstring(webpage, base_url=url)
-    doc.make_links_absolute()
-    title = doc.get_element_by_id('issue-title').text_content()
-    description = doc.xpath('//meta[@name="description"]')[0].get('content')
-    messages = doc.xpath('//ui/div[@class="comment"]')
+    title, description, validators = await render.run(
+      parse_webpage, url, webpage)
 
     rss_info = {
       'title': f'{title} - {user}/{repo} - {host}',
       'description': description,
     }
 
-    rss = base.data2rss(
-      url,
-      rss_info,
-      messages,
-      message_proc,
-    )
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
-  async def _get_url(self, url):
-    res = await httpclient.fetch(url, raise_error=False)
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-    return res.body.decode('utf-8')
+    if self.not_modified([title, description] + validators):
+      return
+
+    items = await render.run(page_items, url, webpage)
+    xml = await render.feed(url, rss_info, items)
+    await self.finish_feed(xml)
+
+def _parse(url, webpage):
+  doc = fromstring(webpage, base_url=url)
+  doc.make_links_absolute()
+  return doc, doc.xpath('//ui/div[@class="comment"]')
+
+def parse_webpage(url, webpage):
+  '''Return the title, description and comment validators of an issue page'''
+  doc, messages = _parse(url, webpage)
+  title = doc.get_element_by_id('issue-title').text_content()
+  description = doc.xpath('//meta[@name="description"]')[0].get('content')
+  validators = [m.xpath('div/div/span/a')[-1].get('href') for m in messages]
+  return title, description, validators
+
+def page_items(url, webpage):
+  '''Return the items of an issue page, once it's known to have changed'''
+  _, messages = _parse(url, webpage)
+  items = [message_proc(m) for m in messages]
+  return [x for x in items if x]
 
 def message_proc(message):
   author_link, anchor = message.xpath('div/div/span/a')
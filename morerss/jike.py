@@ -1,15 +1,12 @@
-import json
 import datetime
 import PyRSS2Gen
 
 from functools import partial
-from lxml.html import fromstring
-from tornado import web
-from tornado.httpclient import AsyncHTTPClient
 
-from . import base
+from . import base, upstream, render, embedded
 
-httpclient = AsyncHTTPClient()
+
+site = upstream.Site('jike')
 
 
 def post2rss(data_plan, post):
@@ -68,15 +65,26 @@ def post2rss(data_plan, post):
   return item
 
 
+def posts_validators(rss_info, posts):
+  validators = [rss_info['title'], rss_info['description']]
+  validators.extend(post['id'] for post in posts)
+  return validators
+
+
+def page_props(body):
+  '''The data a page is rendered from'''
+  data = embedded.script_json(body, 'type', 'application/json')
+  return data['props']['pageProps']
+
+
 class JikeUserHandler(base.BaseHandler):
+  cache_args = ('data',)
+
   async def get(self, uid):
     url = f'https://m.okjike.com/users/{uid}'
-    webpage = await self._get_url(url)
+    res = await site.fetch(url)
 
-    doc = fromstring(webpage, base_url=url)
-    doc.make_links_absolute()
-
-    data = json.loads(doc.xpath('//script[@type="application/json"]')[0].text_content())['props']['pageProps']
+    data = await render.run(page_props, res.body)
 
     rss_info = {
       'title': '%s - 即刻用户' % data['user']['screenName'],
@@ -87,34 +95,26 @@ class JikeUserHandler(base.BaseHandler):
     if data_plan not in ('limited', 'unlimited'):
       data_plan = 'limited'
 
-    rss = base.data2rss(
+    if self.not_modified(posts_validators(rss_info, data['posts'])):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
       data['posts'],
       partial(post2rss, data_plan),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
-  async def _get_url(self, url):
-    res = await httpclient.fetch(url, raise_error=False)
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-    return res.body.decode('utf-8')
+    await self.finish_feed(xml)
 
 
 class JikeTopicHandler(base.BaseHandler):
+  cache_args = ('data',)
+
   async def get(self, tid):
     url = f'https://m.okjike.com/topics/{tid}'
-    webpage = await self._get_url(url)
-
-    doc = fromstring(webpage, base_url=url)
-    doc.make_links_absolute()
+    res = await site.fetch(url)
 
-    data = json.loads(doc.xpath('//script[@type="application/json"]')[0].text_content())['props']['pageProps']
+    data = await render.run(page_props, res.body)
 
     rss_info = {
       'title': '%s - 即刻圈子' % data['topic']['content'],
@@ -125,20 +125,13 @@ class JikeTopicHandler(base.BaseHandler):
     if data_plan not in ('limited', 'unlimited'):
       data_plan = 'limited'
 
-    rss = base.data2rss(
+    if self.not_modified(posts_validators(rss_info, data['posts'])):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
       data['posts'],
       partial(post2rss, data_plan),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
-  async def _get_url(self, url):
-    res = await httpclient.fetch(url, raise_error=False)
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-    return res.body.decode('utf-8')
+    await self.finish_feed(xml)
@@ -1,19 +1,23 @@
+import re
 import json
 from datetime import datetime
 from functools import partial
 
 import PyRSS2Gen
-from tornado import web
-from tornado.httpclient import AsyncHTTPClient
 
-from . import base
-
-
-httpclient = AsyncHTTPClient()
+from . import base, cache, upstream, render
 
+re_fragment_def = re.compile(r'fragment\s+(\w+)\s+on\b')
+# "...Name", but not inline fragments like "... on User"
+re_fragment_spread = re.compile(r'\.\.\.\s*(?!on\b)(\w+)')
 
 class MattersAPI:
   endpoint = 'https://server.matters.news/graphql'
+  # comments asked for under each article when they can't be filtered by
+  # the user's id yet
+  unfiltered_comments = 50
+  # seconds to remember the id of a user name
+  user_id_ttl = 30 * 86400
   user_agent = 'Mozilla/5.0 (X11; Linux x86_64; rv:63.0) Gecko/20100101 Firefox/63.0'
 
   article_fragment = """
@@ -60,214 +64,208 @@ class MattersAPI:
     }
   """
 
-  async def _get_json(self, query):
-    headers = {
-      'User-Agent': self.user_agent,
-      'Content-Type': 'application/json',
-    }
-
-    res = await httpclient.fetch(self.endpoint, raise_error=False, headers=headers,
-                                 method='POST', body=json.dumps({'query':query}))
-
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-
-    return json.loads(res.body.decode('utf-8'))
-
-  async def get_feed(self, feed_type):
-    query = """
-      query {
-        viewer {
-          id
-          recommendation {
-            feed: %s (input: { first: 10 }) {
-              edges {
-                node {
-                  ...ArticleFeed
-                }
-              }
-            }
-          }
-        }
-      }
-
-      %s
-    """ % (feed_type, self.article_fragment)
-
-    res = await self._get_json(query)
-    return res['data']['viewer']['recommendation']['feed']
-
-  async def get_articles_by_circle(self, cname):
-
-    query = """
-      query {
-        circle(input: { name: "%s" }) {
-          id
-          displayName
-          description
-          articles: works(input: { first: 5 }) {
-            edges {
-              node {
-                ...ArticleFeed
-              }
-            }
-          }
-        }
-      }
-
-      %s
-    """ % (cname, self.article_fragment)
-
-    res = await self._get_json(query)
-    return res['data']
-
-  async def get_articles_by_user(self, uname):
+  thread_comment_fragment = """
+    fragment ThreadCommentCommentPublic on Comment {
+      id
+      ...NestedCommentFeed
 
-    query = """
-      query {
-        user(input: { userName: "%s" }) {
-          displayName
-          info {
-            description
-          }
-          articles(input: { first: 20 }) {
-            edges {
-              node {
-                ...ArticleFeed
-              }
-            }
+      comments(input: { sort: oldest, first: null }) {
+        edges {
+          node {
+            ...NestedCommentFeed
           }
         }
       }
+    }
+  """
 
-      %s
-    """ % (uname, self.article_fragment)
-
-    res = await self._get_json(query)
+  def __init__(self):
+    self.site = upstream.Site('matters', headers={
+      'User-Agent': self.user_agent,
+      'Content-Type': 'application/json',
+    })
+    # user name -> id
+    self._user_ids = cache.LRUCache(1024 * 1024)
+    # fragment name -> definition
+    self.fragments = {}
+    for f in (self.article_fragment, self.comment_fragment,
+              self.nested_comment_fragment, self.thread_comment_fragment):
+      self.fragments[re_fragment_def.search(f).group(1)] = f
+
+  def compose(self, selections):
+    """
+    Build one query for several root selections
+    :param selections (dict): alias -> selection, e.g. 'circle(...) { ... }'
+    :return (str): the query, with the fragments the selections use
+    """
+    body = '\n'.join(
+      '%s: %s' % (alias, selection) for alias, selection in selections.items())
+
+    used = []
+    pending = re_fragment_spread.findall(body)
+    while pending:
+      name = pending.pop()
+      if name not in used:
+        used.append(name)
+        pending.extend(re_fragment_spread.findall(self.fragments[name]))
+
+    return 'query {\n%s\n}\n%s' % (
+      body, '\n'.join(self.fragments[name] for name in sorted(used)))
+
+  async def query(self, selections):
+    """
+    Fetch several root selections in one round trip
+    :return (dict): alias -> data
+    """
+    res = await self._get_json(self.compose(selections))
     return res['data']
 
-  async def get_articles_by_topic(self, tid, article_type):
+  async def _get_json(self, query):
+    res = await self.site.fetch(self.endpoint, method='POST',
+                                body=json.dumps({'query':query}))
+    return json.loads(res.body.decode('utf-8'))
 
-    query = """
-      query {
-        node(input: { id: "%s" }) {
-          ... on Tag {
-            id
-            content
-            description
-            articles(input: { first: 10, selected: %s }) {
-              edges {
-                node {
-                  ...ArticleFeed
-                }
-              }
+  async def get_feed(self, feed_type):
+    data = await self.query({'viewer': """viewer {
+      id
+      recommendation {
+        feed: %s (input: { first: 10 }) {
+          edges {
+            node {
+              ...ArticleFeed
             }
           }
         }
       }
-
-      %s
-    """ % (tid, 'false' if article_type != 'selected' else 'true', self.article_fragment)
-
-    res = await self._get_json(query)
-    return res['data']
-
-  async def get_broadcast_by_circle(self, cname):
-    query = """
-      query {
-        circle(input: { name: "%s" }) {
-          id
-          displayName
-          description
-
-          broadcast(input: { first: 10 }) {
-            edges {
-              node {
-                ...ThreadCommentCommentPublic
-              }
+    }""" % feed_type})
+    return data['viewer']['recommendation']['feed']
+
+  async def get_circle(self, cname, sections):
+    """
+    :param sections (list): some of 'articles' and 'broadcast'
+    :return (dict): section -> circle with that section
+    """
+    selections = {}
+    if 'articles' in sections:
+      selections['articles'] = """circle(input: { name: %s }) {
+        id
+        displayName
+        description
+        articles: works(input: { first: 5 }) {
+          edges {
+            node {
+              ...ArticleFeed
             }
           }
         }
-      }
-
-      fragment ThreadCommentCommentPublic on Comment {
+      }""" % json.dumps(cname)
+    if 'broadcast' in sections:
+      selections['broadcast'] = """circle(input: { name: %s }) {
         id
-        ...NestedCommentFeed
+        displayName
+        description
 
-        comments(input: { sort: oldest, first: null }) {
+        broadcast(input: { first: 10 }) {
           edges {
             node {
-              ...NestedCommentFeed
+              ...ThreadCommentCommentPublic
             }
           }
         }
-      }
-
-      %s
-
-      %s
-
-      %s
-    """ % (cname, self.nested_comment_fragment,
-           self.comment_fragment, self.article_fragment)
-    res = await self._get_json(query)
-
-    for edge in res['data']['circle']['broadcast']['edges']:
-      edge['node']['__typename'] = 'Broadcast'
-
-    return res['data']
-
-  async def get_comments_by_user(self, uid):
-    query = """
-      query {
-        node(input: { id: "%s" }) {
-          ... on User {
-            commentedArticles(input: { first: 5 }) {
+      }""" % json.dumps(cname)
+
+    data = await self.query(selections)
+
+    if 'broadcast' in data:
+      for edge in data['broadcast']['broadcast']['edges']:
+        edge['node']['__typename'] = 'Broadcast'
+
+    return data
+
+  async def get_user(self, uname, articles=True, comments=True):
+    """
+    :return (dict): the user, with its articles and comments as asked for
+
+    Comments are those of the user under its commentedArticles, each with
+    the article it is under as its node. The articles are selected once
+    rather than for every comment. The comments are filtered by author on
+    the server once the user's id is known from an earlier query; before
+    that, only the user's among the first unfiltered_comments comments
+    under each article are found.
+    """
+    uid = self._user_ids.get(uname)
+    if uid is None:
+      comments_input = 'first: %d' % self.unfiltered_comments
+    else:
+      comments_input = 'filter: { author: %s }, first: null' % json.dumps(uid)
+
+    parts = []
+    if articles:
+      parts.append("""articles(input: { first: 20 }) {
+        edges {
+          node {
+            ...ArticleFeed
+          }
+        }
+      }""")
+    if comments:
+      parts.append("""commentedArticles(input: { first: 5 }) {
+        edges {
+          node {
+            ...ArticleFeed
+            comments(input: { %s }) {
               edges {
                 node {
-                  comments(input: { filter: { author: "%s" }, first: null }) {
-                    edges {
-                      node {
-                        ...NestedCommentFeed
-                      }
-                    }
-                  }
+                  ...CommentFeed
+                  replyTo { ...CommentFeed }
+                  parentComment { id }
                 }
               }
             }
           }
         }
-      }
-
-      %s
+      }""" % comments_input)
 
+    data = await self.query({'user': """user(input: { userName: %s }) {
+      id
+      userName
+      displayName
+      info {
+        description
+      }
       %s
+    }""" % (json.dumps(uname), '\n'.join(parts))})
+    user = data['user']
+    if user is not None:
+      # ids never change, and are needed to filter comments by
+      self._user_ids.set(uname, user['id'], len(uname) + len(user['id']) + 64,
+                         self.user_id_ttl)
+
+    if comments:
+      user['comments'] = []
+      for edge in user.pop('commentedArticles')['edges']:
+        article = edge['node']
+        for edge1 in article.pop('comments')['edges']:
+          if edge1['node']['author']['id'] == user['id']:
+            edge1['node']['node'] = article
+            user['comments'].append(edge1)
+    return user
 
-      %s
-    """ % (uid, uid, self.nested_comment_fragment,
-           self.comment_fragment, self.article_fragment)
-
-    res = await self._get_json(query)
-    return res['data']['node']
-
-  async def get_user_by_name(self, uname):
-    query = """
-      query {
-        user(input: { userName: "%s" }) {
-          id
-          userName
-          displayName
-          info {
-            description
+  async def get_articles_by_topic(self, tid, article_type):
+    return await self.query({'node': """node(input: { id: %s }) {
+      ... on Tag {
+        id
+        content
+        description
+        articles(input: { first: 10, selected: %s }) {
+          edges {
+            node {
+              ...ArticleFeed
+            }
           }
         }
       }
-    """ % uname
-
-    res = await self._get_json(query)
-    return res['data']
+    }""" % (json.dumps(tid), 'false' if article_type != 'selected' else 'true')})
 
 
 matters_api = MattersAPI()
@@ -379,7 +377,16 @@ def comment2rssitem(edge):
   return item
 
 
+def edges_validators(rss_info, edges):
+  validators = [rss_info['title'], rss_info['description']]
+  validators.extend(
+    (edge['node']['id'], edge['node']['createdAt']) for edge in edges)
+  return validators
+
+
 class MattersCircleHandler(base.BaseHandler):
+  cache_args = ('article', 'broadcast')
+
   async def get(self, cname):
     url = f'https://matters.news/~{cname}'
 
@@ -389,15 +396,17 @@ class MattersCircleHandler(base.BaseHandler):
     circle = None
     edges = []
 
+    sections = []
     if is_article == '1':
-      data = await matters_api.get_articles_by_circle(cname)
-      circle = data['circle']
-      edges.extend(circle['articles']['edges'])
-
+      sections.append('articles')
     if is_broadcast == '1':
-      data = await matters_api.get_broadcast_by_circle(cname)
-      circle = data['circle']
-      edges.extend(circle['broadcast']['edges'])
+      sections.append('broadcast')
+
+    if sections:
+      data = await matters_api.get_circle(cname, sections)
+      for field in sections:
+        circle = data[field]
+        edges.extend(circle[field]['edges'])
 
     if circle:
       rss_info = {
@@ -410,18 +419,21 @@ class MattersCircleHandler(base.BaseHandler):
         'description': '',
       }
 
-    rss = base.data2rss(
+    if self.not_modified(edges_validators(rss_info, edges)):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
       edges,
       partial(edge2rssitem),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
+    await self.finish_feed(xml)
 
 
 class MattersFeedHandler(base.BaseHandler):
+  cache_args = ('type',)
+
   async def get(self):
     url = 'https://matters.news/'
 
@@ -442,18 +454,21 @@ class MattersFeedHandler(base.BaseHandler):
       'description': '',
     }
 
-    rss = base.data2rss(
+    if self.not_modified(edges_validators(rss_info, data['edges'])):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
       data['edges'],
       partial(article2rssitem),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
+    await self.finish_feed(xml)
 
 
 class MattersUserHandler(base.BaseHandler):
+  cache_args = ('article', 'response')
+
   async def get(self, uname):
     url = f'https://matters.news/@{uname}'
 
@@ -462,18 +477,14 @@ class MattersUserHandler(base.BaseHandler):
 
     user = None
     edges = []
-    if is_article == '1':
-      data = await matters_api.get_articles_by_user(uname)
-      user = data['user']
-      edges.extend(data['user']['articles']['edges'])
-
-    if is_response == '1':
-      data = await matters_api.get_user_by_name(uname)
-      user = data['user']
 
-      data = await matters_api.get_comments_by_user(user['id'])
-      edges.extend([edge1 for edge in data['commentedArticles']['edges']
-                          for edge1 in edge['node']['comments']['edges']])
+    if is_article == '1' or is_response == '1':
+      user = await matters_api.get_user(
+        uname, articles=is_article == '1', comments=is_response == '1')
+      if is_article == '1':
+        edges.extend(user['articles']['edges'])
+      if is_response == '1':
+        edges.extend(user['comments'])
 
     if user:
       rss_info = {
@@ -486,18 +497,20 @@ class MattersUserHandler(base.BaseHandler):
         'description': '',
       }
 
-    rss = base.data2rss(
+    if self.not_modified(edges_validators(rss_info, edges)):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
       edges,
       partial(edge2rssitem),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
+    await self.finish_feed(xml)
 
 class MattersTopicHandler(base.BaseHandler):
+  cache_args = ('type',)
+
   async def get(self, tid):
     url = f'https://matters.news/tags/{tid}'
 
@@ -512,12 +525,14 @@ class MattersTopicHandler(base.BaseHandler):
       'description': data['node']['description'],
     }
 
-    rss = base.data2rss(
+    edges = data['node']['articles']['edges']
+    if self.not_modified(edges_validators(rss_info, edges)):
+      return
+
+    xml = await render.feed(
       url,
       rss_info,
-      data['node']['articles']['edges'],
+      edges,
       partial(article2rssitem),
     )
-
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
+    await self.finish_feed(xml)
@@ -0,0 +1,210 @@
+'''A pool of HTTP proxies for zhihu, listed in --zhihu-proxy-file.
+
+Proxies are picked at random, weighted by their recent latency and success
+rate, so that fast and reliable ones carry most requests while the others
+are still tried now and then. Proxies zhihu bans are quarantined for a
+while. Proxying needs the curl HTTP client.
+'''
+
+import os
+import copy
+import time
+import random
+import asyncio
+import logging
+
+from tornado import web
+from tornado.options import options, define
+
+from . import base
+
+define("zhihu-proxy-file", default='',
+       help="file listing proxies for zhihu, one host:port per line", type=str)
+define("zhihu-proxy-quarantine", default=600.0,
+       help="seconds to stop using a proxy zhihu has banned; doubled each time it's banned again", type=float)
+define("zhihu-proxy-max-quarantine", default=86400.0,
+       help="maximum seconds to stop using a banned proxy", type=float)
+define("zhihu-proxy-hedge", default=0.0,
+       help="seconds after which a slow request is also sent through another proxy, 0 to disable", type=float)
+
+logger = logging.getLogger(__name__)
+
+class Proxy:
+  __slots__ = ('addr', 'host', 'port', 'latency', 'failure', 'bans',
+               'quarantined_until', 'active')
+
+  def __init__(self, addr):
+    self.addr = addr
+    host, port = addr.rsplit(':', 1)
+    self.host = host
+    self.port = int(port)
+    # EWMA of seconds per request, None until the first one
+    self.latency = None
+    # EWMA of failures, from 0 (none) to 1 (all)
+    self.failure = 0.0
+    # bans since the last success
+    self.bans = 0
+    self.quarantined_until = 0
+    self.active = 0
+
+  def weight(self, default_latency):
+    latency = self.latency or default_latency
+    # keep trying bad proxies once in a while, in case they get better
+    success = max(1 - self.failure, 0.1)
+    return success * success / (latency * (1 + self.active))
+
+class ProxyPool:
+  # weight of the latest request in the EWMAs
+  alpha = 0.3
+  # seconds between checks for changes to the proxy file
+  reload_interval = 10
+
+  def __init__(self, path, is_banned=None):
+    '''*is_banned* tells from a response whether zhihu banned the proxy'''
+    self.path = path
+    self.is_banned = is_banned or (lambda res: False)
+    self.proxies = {}
+    self._mtime = None
+    self._checked = 0
+    self._reload()
+
+  def _reload(self):
+    self._checked = time.monotonic()
+    try:
+      mtime = os.stat(self.path).st_mtime
+    except OSError as e:
+      logger.error('cannot read proxy file: %s', e)
+      return
+    if mtime == self._mtime:
+      return
+
+    with open(self.path) as f:
+      addrs = [line.split('#', 1)[0].strip() for line in f]
+    # keep what we know about proxies still listed
+    self.proxies = {
+      addr: self.proxies.get(addr) or Proxy(addr)
+      for addr in addrs if addr
+    }
+    self._mtime = mtime
+    logger.info('loaded %d proxies from %s', len(self.proxies), self.path)
+
+  def usable(self, exclude=()):
+    if time.monotonic() - self._checked > self.reload_interval:
+      self._reload()
+    now = time.time()
+    return [p for p in self.proxies.values()
+            if p.quarantined_until <= now and p.addr not in exclude]
+
+  def pick(self, exclude=()):
+    '''Pick a usable proxy not in *exclude*, or raise 503'''
+    proxies = self.usable(exclude)
+    base.STATSC.gauge('zhihu.proxy.usable', len(proxies))
+    if not proxies:
+      raise web.HTTPError(503, 'no usable proxy')
+
+    known = [p.latency for p in proxies if p.latency is not None]
+    default_latency = sum(known) / len(known) if known else 1.0
+    weights = [p.weight(default_latency) for p in proxies]
+    return random.choices(proxies, weights)[0]
+
+  def _record(self, p, failed, latency=None):
+    a = self.alpha
+    p.failure = (1 - a) * p.failure + a * failed
+    if latency is not None:
+      if p.latency is None:
+        p.latency = latency
+      else:
+        p.latency = (1 - a) * p.latency + a * latency
+      base.STATSC.timing('zhihu.proxy.latency', latency * 1000)
+      p.bans = 0
+    else:
+      base.STATSC.incr('zhihu.proxy.failed')
+
+  def ban(self, p):
+    p.bans += 1
+    self._record(p, True)
+    quarantine = min(
+      options.zhihu_proxy_quarantine * 2 ** (p.bans - 1),
+      options.zhihu_proxy_max_quarantine)
+    p.quarantined_until = time.time() + quarantine
+    logger.warning('proxy %s is banned by zhihu; not using it for %ds',
+                   p.addr, quarantine)
+    base.STATSC.incr('zhihu.proxy.banned')
+
+  async def fetch(self, request, send):
+    '''Send *request* through a proxy with ``send(request)``
+
+    With --zhihu-proxy-hedge, a request that takes too long or fails is
+    also sent through another proxy, and the first good response wins. A
+    failed or banned response is returned only if all attempts failed.
+    '''
+    used = set()
+    tasks = [asyncio.ensure_future(self._fetch_via(request, send, used))]
+    try:
+      hedge = options.zhihu_proxy_hedge
+      if hedge:
+        done, _ = await asyncio.wait(tasks, timeout=hedge)
+        if (not done or _failed(tasks[0])) and self.usable(used):
+          base.STATSC.incr('zhihu.proxy.hedged')
+          tasks.append(
+            asyncio.ensure_future(self._fetch_via(request, send, used)))
+
+      pending = set(tasks)
+      while pending:
+        done, pending = await asyncio.wait(
+          pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if not _failed(task):
+            return task.result()[0]
+
+      # all failed: a response is handled by the caller like one for a
+      # direct request, so prefer it to an exception
+      for task in tasks:
+        if task.exception() is None:
+          return task.result()[0]
+      raise tasks[0].exception()
+    finally:
+      for task in tasks:
+        base.discard(task)
+
+  async def _fetch_via(self, request, send, used):
+    p = self.pick(used)
+    used.add(p.addr)
+    request = copy.copy(request)
+    request.proxy_host = p.host
+    request.proxy_port = p.port
+
+    p.active += 1
+    start_time = time.monotonic()
+    try:
+      res = await send(request)
+    except asyncio.CancelledError:
+      raise
+    except Exception:
+      self._record(p, True)
+      raise
+    finally:
+      p.active -= 1
+
+    # the response is returned either way, with whether it's good
+    if res.code == 599:
+      self._record(p, True)
+      return res, False
+    elif self.is_banned(res):
+      self.ban(p)
+      return res, False
+    else:
+      self._record(p, False, time.monotonic() - start_time)
+      return res, True
+
+def _failed(task):
+  '''Whether a finished ProxyPool._fetch_via() task didn't get a good response'''
+  return task.exception() is not None or not task.result()[1]
+
+_pool = None
+
+def get_pool(is_banned=None):
+  global _pool
+  if _pool is None:
+    _pool = ProxyPool(options.zhihu_proxy_file, is_banned)
+  return _pool
@@ -0,0 +1,105 @@
+'''Rendering feeds off the event loop.
+
+Parsing upstream pages and serializing feeds takes CPU time, during which
+no other connection is served. With --render-workers, that work runs in a
+pool of processes (or threads, see --render-executor) instead, so that
+cached feeds keep being served while big pages render on other cores.
+
+Functions given to run(), their arguments and their results must be
+picklable: module-level functions or partials of them, taking page text or
+JSON data rather than lxml trees, and returning plain data or RSSItems.
+They must not have side effects such as queueing fetches, as they may run
+in another process.
+'''
+
+import time
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from tornado.options import options, define
+
+from . import base
+
+define("render-workers", default=0,
+       help="processes or threads rendering feeds, 0 to render on the event loop", type=int)
+define("render-executor", default='process',
+       help="what renders feeds with --render-workers: process or thread", type=str)
+define("render-batch", default=10,
+       help="feed items rendered at a time with --render-workers", type=int)
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = {
+  'process': ProcessPoolExecutor,
+  'thread': ThreadPoolExecutor,
+}
+
+_executor = None
+
+def get_executor():
+  '''The executor renders run in, or None to run them in place'''
+  global _executor
+  if _executor is None and options.render_workers > 0:
+    try:
+      cls = EXECUTORS[options.render_executor]
+    except KeyError:
+      raise ValueError('unknown render executor: %r'
+                       % options.render_executor)
+    _executor = cls(max_workers=options.render_workers)
+    logger.info('rendering feeds in %d %s workers',
+                options.render_workers, options.render_executor)
+  return _executor
+
+async def run(func, *args, **kwargs):
+  '''Call *func* in the render executor and return its result'''
+  executor = get_executor()
+  start_time = time.time()
+  if executor is None:
+    result = func(*args, **kwargs)
+  else:
+    result = await asyncio.get_running_loop().run_in_executor(
+      executor, partial(func, *args, **kwargs))
+  used_time = time.time() - start_time
+  base.STATSC.timing('render.%s' % func.__name__, used_time * 1000)
+  return result
+
+def items_xml(data, transform_func=None):
+  '''The XML of some items of a feed, to be sent back from a worker'''
+  return ''.join(base.item_xml(x, transform_func) for x in data)
+
+async def feed(url, info, data, transform_func=None):
+  '''The chunks of XML of a feed, for BaseHandler.finish_feed()
+
+  Without a render executor, each item is rendered as the chunks are
+  consumed. With one, items are rendered there --render-batch at a time,
+  the next batch while the current one is sent, so that the feed is sent
+  as it's rendered either way.
+  '''
+  if get_executor() is None:
+    return base.rss_chunks(url, info, data, transform_func)
+  return _batches(url, info, list(data), transform_func)
+
+async def _batches(url, info, data, transform_func):
+  size = max(options.render_batch, 1)
+  batches = [data[i:i+size] for i in range(0, len(data), size)]
+  yield base.rss_head(url, info)
+
+  def start(batch):
+    return asyncio.ensure_future(run(items_xml, batch, transform_func))
+
+  pending = None
+  try:
+    for i, batch in enumerate(batches):
+      xml = await (pending or start(batch))
+      pending = None
+      if i + 1 < len(batches):
+        pending = start(batches[i+1])
+      if xml:
+        yield xml
+  finally:
+    if pending is not None:
+      base.discard(pending)
+
+  yield base.RSS_END
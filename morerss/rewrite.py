@@ -0,0 +1,56 @@
+'''Rewriting HTML content in one walk over the tree.
+
+A Rewriter is made of rules, each a function called with an element of a
+given tag. All the elements any rule wants are selected with one
+precompiled XPath before the rules run, and visited in document order,
+each with the rules of its tag in the order they were given.
+
+A rule is called with the element and a dict, new for every document,
+to keep what it has seen so far in. It may change the element in place,
+or put something else in its place and return that; later rules of the
+tag are skipped then. It may also remove childless elements after its
+own, such as a following sibling; those are skipped when reached.
+'''
+
+from lxml import etree
+
+from . import base
+
+class Rewriter:
+  def __init__(self, rules):
+    '''*rules* is a sequence of (tag, function) pairs'''
+    self._rules = {}
+    for tag, func in rules:
+      self._rules.setdefault(tag, []).append(func)
+    self._select = etree.XPath(
+      ' | '.join('//%s' % tag for tag in self._rules))
+
+  def __call__(self, doc):
+    '''Rewrite *doc* and return it, or what has been put in its place'''
+    if not self._rules:
+      return doc
+
+    state = {}
+    for el in self._select(doc):
+      if el is not doc and el.getparent() is None:
+        # removed by a rule for an earlier element
+        continue
+      for func in self._rules[el.tag]:
+        new = func(el, state)
+        if new is not None:
+          if el is doc:
+            doc = new
+          break
+    return doc
+
+def proxify_rule(pattern, pic):
+  '''A rule for img elements that loads pictures matching *pattern* via *pic*
+
+  *pic* names one of base.PIC_PROXIES.
+  '''
+  proxify = base.PIC_PROXIES[pic]
+  def rule(img, state):
+    src = img.get('src')
+    if src is not None and pattern.match(src):
+      img.set('src', proxify(src))
+  return rule
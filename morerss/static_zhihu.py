@@ -21,6 +21,10 @@ body {{ max-width: 700px; margin: auto; }}
 logger = logging.getLogger(__name__)
 
 class StaticZhihuHandler(BaseHandler):
+  # articles rarely change once published
+  cache_ttl = 86400
+  cache_args = ('pic',)
+
   async def get(self, id):
     pic = self.get_argument('pic', None)
     article = await fetch_article(id, pic)
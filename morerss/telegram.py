@@ -1,48 +1,53 @@
-from functools import partial
 import datetime
 
 import PyRSS2Gen
-from tornado import web
-from tornado.httpclient import AsyncHTTPClient
 from lxml.html import fromstring, tostring, Element
 
 from .base import BaseHandler
-from . import base
+from . import upstream, render
 
-httpclient = AsyncHTTPClient()
+site = upstream.Site('telegram')
 
 class TGChannelHandler(BaseHandler):
+  cache_ttl = 600
+
   async def get(self, channel):
     url = f'https://t.me/s/{channel}'
-    webpage = await self._get_url(url)
-
-    doc = fromstring(webpage, base_url=url)
-    doc.make_links_absolute()
-    title = doc.xpath('//meta[@property="og:title"]')[0].get('content')
-    description = doc.xpath('//meta[@property="og:description"]')[0].get('content')
-    messages = doc.xpath('//div[@data-post]')[::-1]
-
-    rss_info = {
-      'title': title,
-      'description': description,
-    }
-
-    rss = base.data2rss(
-      url,
-      rss_info,
-      messages,
-      message_proc,
-    )
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
-  async def _get_url(self, url):
-    res = await httpclient.fetch(url, raise_error=False)
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-    return res.body.decode('utf-8')
+    webpage = await site.get_text(url)
+
+    rss_info, validators = await render.run(parse_webpage, url, webpage)
+    if self.not_modified(validators):
+      return
+
+    items = await render.run(page_items, url, webpage)
+    xml = await render.feed(url, rss_info, items)
+    await self.finish_feed(xml)
+
+def _parse(url, webpage):
+  doc = fromstring(webpage, base_url=url)
+  doc.make_links_absolute()
+  return doc, doc.xpath('//div[@data-post]')[::-1]
+
+def parse_webpage(url, webpage):
+  '''Return the info and validators of a channel page'''
+  doc, messages = _parse(url, webpage)
+  title = doc.xpath('//meta[@property="og:title"]')[0].get('content')
+  description = doc.xpath('//meta[@property="og:description"]')[0].get('content')
+
+  rss_info = {
+    'title': title,
+    'description': description,
+  }
+
+  validators = [title, description]
+  validators.extend(m.get('data-post') for m in messages)
+  return rss_info, validators
+
+def page_items(url, webpage):
+  '''Return the items of a channel page, once it's known to have changed'''
+  _, messages = _parse(url, webpage)
+  items = [message_proc(m) for m in messages]
+  return [x for x in items if x]
 
 def message_proc(message):
   url = f"https://t.me/s/{message.get('data-post')}"
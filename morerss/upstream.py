@@ -0,0 +1,597 @@
+'''Fetching from upstream sites, shared by all handlers.
+
+Handlers fetch through a Site, which adds the site's default headers and
+turns error responses into web.HTTPError the same way for every site. Each
+site has a Pool of connections of its own, so that a slow site only delays
+its own feeds.
+
+GET responses are cached according to their Cache-Control / Expires
+headers and revalidated with If-None-Match / If-Modified-Since once
+stale. Identical GETs in flight at the same time are sent only once.
+
+Requests to a host can be paced with a Limiter, so that we stay below the
+rate at which it starts blocking us. A site that keeps failing or
+rate-limiting us is left alone for a while by its Breaker.
+
+Upstream resources found to be gone or forbidden are remembered for a while
+(see check_negative / remember_negative), so that feeds of deleted users
+or topics don't cost a request every time they're polled.
+'''
+
+import time
+import math
+import copy
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from functools import partial
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+try:
+  import pycurl
+  AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+except ImportError:
+  pycurl = None
+from tornado import web
+from tornado.httputil import HTTPHeaders
+from tornado.options import options, define
+
+from . import base, cache
+
+define("upstream-max-clients", default=10,
+       help="maximum concurrent requests to each upstream site; more are queued", type=int)
+define("upstream-pool-sizes", default='',
+       help="--upstream-max-clients for particular sites, e.g. zhihu=20,gogs=2", type=str)
+define("upstream-connect-timeout", default=10.0,
+       help="seconds to wait for connecting to an upstream", type=float)
+define("upstream-request-timeout", default=30.0,
+       help="seconds to wait for a whole upstream response", type=float)
+define("upstream-breaker-failures", default=3,
+       help="consecutive failures of an upstream site before leaving it alone", type=int)
+define("upstream-breaker-cooldown", default=30.0,
+       help="seconds to leave a failing upstream site alone at first; doubled every time it fails again", type=float)
+define("upstream-breaker-max-cooldown", default=900.0,
+       help="maximum seconds to leave a failing upstream site alone", type=float)
+define("upstream-cache-size", default=32,
+       help="maximum size of the upstream response cache in MiB", type=int)
+define("upstream-gone-ttl", default=21600,
+       help="seconds to remember upstream resources that are 404 or 410", type=int)
+define("upstream-forbidden-ttl", default=3600,
+       help="seconds to remember upstream resources that are 401 or 403", type=int)
+
+logger = logging.getLogger(__name__)
+
+# how long to keep a stale response around for revalidation
+_REVALIDATE_KEEP = 86400
+
+class _CachedResponse:
+  __slots__ = ('response', 'expires', 'etag', 'last_modified')
+
+  def __init__(self, response, expires):
+    self.response = response
+    self.expires = expires
+    self.etag = response.headers.get('Etag')
+    self.last_modified = response.headers.get('Last-Modified')
+
+  @property
+  def size(self):
+    return len(self.response.body or b'') + 1024
+
+_cache = None
+# cache key -> Future of the fetch in progress for it
+_inflight = {}
+# upstream key -> (status, log_message) to raise
+_negative = cache.LRUCache(4 * 1024 * 1024)
+
+class Pool:
+  '''An HTTP client of its own for the requests to one upstream site
+
+  *max_clients*, *connect_timeout* and *request_timeout* default to the
+  --upstream-* options. The requests in flight and waiting for a
+  connection are reported as gauges.
+  '''
+  def __init__(self, name, *, max_clients=None,
+               connect_timeout=None, request_timeout=None):
+    self.name = name
+    self.max_clients = max_clients
+    self.connect_timeout = connect_timeout
+    self.request_timeout = request_timeout
+    self.pending = 0
+    self._client = None
+    self._metric = 'upstream.pool.%s' % name
+
+  def _get_client(self):
+    if self._client is None:
+      if self.max_clients is None:
+        self.max_clients = _pool_sizes().get(
+          self.name, options.upstream_max_clients)
+      # curl keeps connections to each host alive between requests, and
+      # both clients ask for and decode gzip'ed responses
+      self._client = AsyncHTTPClient(
+        force_instance = True,
+        max_clients = self.max_clients,
+        defaults = dict(
+          connect_timeout = self.connect_timeout or options.upstream_connect_timeout,
+          request_timeout = self.request_timeout or options.upstream_request_timeout,
+          decompress_response = True,
+        ),
+      )
+    return self._client
+
+  async def fetch(self, request):
+    client = self._get_client()
+    self.pending += 1
+    self._gauge()
+    try:
+      return await client.fetch(request, raise_error=False)
+    finally:
+      self.pending -= 1
+      self._gauge()
+
+  def _gauge(self):
+    # both clients queue what's over max_clients in order
+    active = min(self.pending, self.max_clients)
+    base.STATSC.gauge(self._metric + '.active', active)
+    base.STATSC.gauge(self._metric + '.queued', self.pending - active)
+
+def _pool_sizes():
+  sizes = {}
+  for item in options.upstream_pool_sizes.split(','):
+    name, _, size = item.partition('=')
+    if size:
+      sizes[name.strip()] = int(size)
+  return sizes
+
+# for requests not made through a Site
+_default_pool = Pool('default')
+
+def _get_cache():
+  global _cache
+  if _cache is None:
+    _cache = cache.LRUCache(options.upstream_cache_size * 1024 * 1024)
+  return _cache
+
+def check_negative(key):
+  '''Raise the error remembered for the upstream resource *key*, if any'''
+  error = _negative.get(key)
+  if error is not None:
+    base.STATSC.incr('upstream.negative_hit')
+    raise web.HTTPError(*error)
+
+def remember_negative(key, status, log_message=None):
+  '''Remember that the upstream resource *key* answers with *status*
+
+  check_negative() will raise web.HTTPError(status, log_message) for it
+  until the TTL for its status class runs out.
+  '''
+  if status in (404, 410):
+    ttl = options.upstream_gone_ttl
+  elif status in (401, 403):
+    ttl = options.upstream_forbidden_ttl
+  else:
+    raise ValueError('not a negative status: %r' % status)
+  _negative.set(key, (status, log_message), len(key) + 128, ttl)
+
+class Limiter:
+  '''Paces the requests to one host.
+
+  A token bucket refilled at *rate* requests per second (0 for no limit)
+  and holding up to *burst* tokens, a cap of *max_active* requests in
+  flight, and a queue of at most *max_queued* requests waiting for either,
+  each for at most *max_wait* seconds. Requests that can't be queued or
+  waited too long fail with 503.
+
+  Use ``async with limiter:`` around each request.
+  '''
+  def __init__(self, name, rate, burst, max_active, max_queued, max_wait):
+    self.name = name
+    self.rate = rate
+    self.burst = burst
+    self.max_active = max_active
+    self.max_queued = max_queued
+    self.max_wait = max_wait
+
+    self.active = 0
+    self._tokens = burst
+    self._refilled = time.monotonic()
+    self._waiters = deque()
+    self._timer = None
+    self._metric = 'upstream.limiter.%s' % name.replace('.', '_')
+
+  def _refill(self):
+    now = time.monotonic()
+    if self.rate:
+      self._tokens = min(
+        self.burst, self._tokens + (now - self._refilled) * self.rate)
+    self._refilled = now
+
+  def _try_take(self):
+    if self.active >= self.max_active:
+      return False
+    if self.rate:
+      self._refill()
+      if self._tokens < 1:
+        return False
+      self._tokens -= 1
+    self.active += 1
+    return True
+
+  def _wake(self):
+    self._timer = None
+    while self._waiters:
+      if self._waiters[0].done():
+        # timed out or cancelled
+        self._waiters.popleft()
+        continue
+      if not self._try_take():
+        break
+      self._waiters.popleft().set_result(None)
+
+    if self._waiters and self.active < self.max_active \
+       and self._timer is None:
+      # waiting for a token
+      delay = (1 - self._tokens) / self.rate
+      self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+
+  def _gauge(self):
+    base.STATSC.gauge(self._metric + '.queued', len(self._waiters))
+
+  async def __aenter__(self):
+    if not self._waiters and self._try_take():
+      return self
+
+    if len(self._waiters) >= self.max_queued:
+      base.STATSC.incr(self._metric + '.rejected')
+      raise web.HTTPError(503, 'too many requests queued for %s' % self.name)
+
+    fut = asyncio.get_running_loop().create_future()
+    self._waiters.append(fut)
+    self._gauge()
+    self._wake()
+    start = time.monotonic()
+    try:
+      await asyncio.wait_for(fut, self.max_wait)
+    except asyncio.TimeoutError:
+      base.STATSC.incr(self._metric + '.timeout')
+      raise web.HTTPError(503, 'timed out waiting for %s' % self.name)
+    except asyncio.CancelledError:
+      if fut.done() and not fut.cancelled():
+        # granted just before we were cancelled
+        self._release()
+      raise
+    finally:
+      try:
+        self._waiters.remove(fut)
+      except ValueError:
+        pass
+      self._gauge()
+      base.STATSC.timing(self._metric + '.wait',
+                         (time.monotonic() - start) * 1000)
+    return self
+
+  async def __aexit__(self, exc_type, exc, tb):
+    self._release()
+
+  def _release(self):
+    self.active -= 1
+    self._wake()
+
+def is_overloaded(res):
+  '''Whether a response means the upstream is failing or rate-limiting us'''
+  return res.code == 429 or res.code >= 500
+
+class CircuitOpen(web.HTTPError):
+  '''Raised instead of sending a request to a site that is failing'''
+  def __init__(self, name, message):
+    super().__init__(503, '%s %s' % (name, message))
+
+class Breaker:
+  '''A circuit breaker for one upstream site.
+
+  After --upstream-breaker-failures consecutive failed requests, requests
+  fail fast with CircuitOpen for a cooldown. Then a single probe request
+  is let through: if it succeeds, all requests are let through again,
+  otherwise the cooldown is doubled.
+
+  *overloaded* tells failed responses from the others, see is_overloaded().
+  *host* is for a breaker of one of the hosts of a site named *name*; it's
+  only logged, so that it doesn't end up in metric names or error pages.
+  '''
+  CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+  def __init__(self, name, overloaded=None, *, host=None):
+    self.name = name
+    self.host = host
+    self.overloaded = overloaded or is_overloaded
+    self.state = self.CLOSED
+    self.failures = 0
+    self.cooldown = 0
+    self.retry_at = 0
+    self._probing = False
+    self._metric = 'upstream.breaker.%s' % name
+
+  def check(self):
+    '''Raise CircuitOpen if a request couldn't be sent now'''
+    if self.state == self.CLOSED:
+      return
+    wait = self.retry_at - time.monotonic()
+    if self.state == self.OPEN and wait > 0:
+      raise CircuitOpen(self.name, 'is failing; retrying in %ds' % math.ceil(wait))
+    if self._probing:
+      raise CircuitOpen(self.name, 'is failing; retrying now')
+
+  def before(self):
+    '''Like check(), and let this request through as the probe if needed'''
+    self.check()
+    if self.state == self.OPEN:
+      self._set_state(self.HALF_OPEN)
+    if self.state == self.HALF_OPEN:
+      self._probing = True
+
+  def record(self, res):
+    if self.overloaded(res):
+      self.failure()
+    else:
+      self.success()
+
+  def success(self):
+    self._probing = False
+    self.failures = 0
+    if self.state != self.CLOSED:
+      self.cooldown = 0
+      self._set_state(self.CLOSED)
+
+  def failure(self):
+    self._probing = False
+    self.failures += 1
+    if self.state == self.HALF_OPEN or (
+      self.state == self.CLOSED
+      and self.failures >= options.upstream_breaker_failures):
+      self.cooldown = min(
+        max(self.cooldown * 2, options.upstream_breaker_cooldown),
+        options.upstream_breaker_max_cooldown)
+      self.retry_at = time.monotonic() + self.cooldown
+      self._set_state(self.OPEN)
+
+  def abandon(self):
+    '''The request let through was cancelled before it finished'''
+    self._probing = False
+
+  def _set_state(self, state):
+    if self.host is None:
+      logger.warning('circuit for %s: %s -> %s', self.name, self.state, state)
+    else:
+      logger.warning('circuit for %s host %r: %s -> %s',
+                     self.name, self.host, self.state, state)
+    self.state = state
+    base.STATSC.incr('%s.%s' % (self._metric, state))
+
+def _cache_key(request):
+  return request.url, tuple(sorted(request.headers.get_all()))
+
+def freshness(headers):
+  '''Seconds a response is fresh for, or None if it must not be stored'''
+  directives = {}
+  for d in headers.get('Cache-Control', '').split(','):
+    k, _, v = d.strip().partition('=')
+    directives[k.lower()] = v.strip('"')
+
+  if 'no-store' in directives:
+    return None
+  if 'no-cache' in directives:
+    return 0
+  if 'max-age' in directives:
+    try:
+      return max(0, int(directives['max-age']) - int(headers.get('Age', 0)))
+    except ValueError:
+      return 0
+
+  expires = headers.get('Expires')
+  if expires:
+    try:
+      date = parsedate_to_datetime(headers.get('Date', expires))
+      return max(0, (parsedate_to_datetime(expires) - date).total_seconds())
+    except (TypeError, ValueError):
+      return 0
+  return 0
+
+async def fetch(request, *, ttl=None, limiter=None, pool=None, breaker=None,
+                proxies=None, **kwargs):
+  '''Fetch *request* (an HTTPRequest or a URL with HTTPRequest arguments).
+
+  Behaves like ``AsyncHTTPClient().fetch(request, raise_error=False)``.
+  The returned response may be shared with other callers and must not be
+  modified.
+
+  *ttl* overrides the freshness lifetime given by the upstream, for
+  resources we know to change slowly. *limiter* paces the requests that
+  actually go out; cache hits and coalesced requests don't count. They
+  are sent through *pool*, or a pool shared by all such callers. When
+  *breaker* is open, an expired cached response is returned if there is
+  one, otherwise CircuitOpen is raised. *proxies* is a proxy.ProxyPool to
+  send the requests through.
+  '''
+  if not isinstance(request, HTTPRequest):
+    request = HTTPRequest(request, **kwargs)
+  if request.method != 'GET':
+    return await _send(request, limiter, pool, breaker, proxies)
+
+  key = _cache_key(request)
+  entry = _get_cache().get(key)
+  if entry is not None and time.time() < entry.expires:
+    base.STATSC.incr('upstream.cache_hit')
+    return entry.response
+
+  fut = _inflight.get(key)
+  if fut is None:
+    fut = asyncio.ensure_future(_fetch(request, key, entry, ttl, limiter, pool, breaker, proxies))
+    _inflight[key] = fut
+    fut.add_done_callback(partial(_fetch_done, key))
+  else:
+    base.STATSC.incr('upstream.coalesced')
+  return await asyncio.shield(fut)
+
+def _fetch_done(key, fut):
+  if _inflight.get(key) is fut:
+    del _inflight[key]
+
+async def _send(request, limiter, pool, breaker, proxies):
+  pool = pool or _default_pool
+  if breaker is not None:
+    # fail fast instead of waiting in the limiter queue first
+    breaker.check()
+  if limiter is None:
+    return await _send_now(request, pool, breaker, proxies)
+  async with limiter:
+    return await _send_now(request, pool, breaker, proxies)
+
+async def _send_now(request, pool, breaker, proxies):
+  if proxies is not None:
+    return await proxies.fetch(request, pool.fetch)
+  if breaker is None:
+    return await pool.fetch(request)
+
+  breaker.before()
+  try:
+    res = await pool.fetch(request)
+  except asyncio.CancelledError:
+    breaker.abandon()
+    raise
+  except Exception:
+    breaker.failure()
+    raise
+  breaker.record(res)
+  return res
+
+async def _fetch(request, key, entry, ttl, limiter, pool, breaker, proxies):
+  if entry is not None and (entry.etag or entry.last_modified):
+    request = copy.copy(request)
+    request.headers = HTTPHeaders(request.headers)
+    if entry.etag:
+      request.headers['If-None-Match'] = entry.etag
+    if entry.last_modified:
+      request.headers['If-Modified-Since'] = entry.last_modified
+
+  try:
+    res = await _send(request, limiter, pool, breaker, proxies)
+  except CircuitOpen:
+    if entry is None:
+      raise
+    base.STATSC.incr('upstream.stale')
+    return entry.response
+
+  if res.code == 304 and entry is not None:
+    base.STATSC.incr('upstream.revalidated')
+    # headers of a 304 update those of the stored response, validators
+    # included, as servers may rotate them
+    headers = copy.copy(entry.response.headers)
+    headers.update(res.headers)
+    response = copy.copy(entry.response)
+    response.headers = headers
+    _store(key, response, ttl)
+    return response
+
+  if res.code == 200:
+    _store(key, res, ttl)
+  return res
+
+def _store(key, res, ttl):
+  fresh = freshness(res.headers) if ttl is None else ttl
+  if fresh is None:
+    return
+
+  entry = _CachedResponse(res, time.time() + fresh)
+  if entry.etag or entry.last_modified:
+    keep = max(fresh, _REVALIDATE_KEEP)
+  else:
+    keep = fresh
+  if keep > 0:
+    _get_cache().set(key, entry, entry.size, keep)
+
+def raise_for_status(url, res):
+  '''Turn an error response for *url* into the web.HTTPError to answer with
+
+  404 is remembered with remember_negative() unless *url* is None, e.g. for
+  POSTs to an API endpoint. 429 and server errors become
+  5xx, so that a stale copy of the feed is served if there is one.
+  '''
+  if res.code == 404:
+    if url is not None:
+      remember_negative(url, 404)
+    raise web.HTTPError(404)
+  elif res.code == 429:
+    raise web.HTTPError(503, 'rate-limited by upstream')
+  elif res.code == 599:
+    raise web.HTTPError(504, 'upstream unreachable: %s' % res.error)
+  elif res.code >= 500:
+    raise web.HTTPError(502, 'upstream error %d' % res.code)
+  elif res.error:
+    res.rethrow()
+
+class Site:
+  '''An upstream site, with the headers to send it by default
+
+  *overloaded* is for the site's Breaker; other keyword arguments
+  configure the site's Pool. A site that is software on whatever hosts
+  users ask for, such as gogs, is *per_host*: each host has its own
+  Breaker then, so that a dead host doesn't stop requests to the others.
+  '''
+  # per-host breakers kept; the least recently used go first
+  max_breakers = 256
+
+  def __init__(self, name, *, headers=None, overloaded=None, per_host=False,
+               **pool_args):
+    self.name = name
+    self.headers = headers or {}
+    self.pool = Pool(name, **pool_args)
+    self.overloaded = overloaded
+    self.per_host = per_host
+    self.breaker = None if per_host else Breaker(name, overloaded)
+    # host -> Breaker, if per_host
+    self._breakers = OrderedDict()
+    self._metric = 'upstream.%s.fetch' % name
+
+  def breaker_for(self, url):
+    '''The Breaker for requests to *url*'''
+    if not self.per_host:
+      return self.breaker
+
+    host = urlsplit(url).hostname
+    breaker = self._breakers.get(host)
+    if breaker is None:
+      # hosts come from users; don't keep a breaker for every one asked for
+      while len(self._breakers) >= self.max_breakers:
+        self._breakers.popitem(last=False)
+      breaker = self._breakers[host] = Breaker(
+        self.name, self.overloaded, host=host)
+    else:
+      self._breakers.move_to_end(host)
+    return breaker
+
+  def request(self, url, *, headers=None, **kwargs):
+    '''An HTTPRequest for *url* with the site's default headers'''
+    merged = HTTPHeaders(self.headers)
+    merged.update(headers or {})
+    return HTTPRequest(url, headers=merged, **kwargs)
+
+  async def fetch(self, url, *, ttl=None, limiter=None, **kwargs):
+    '''Fetch *url*, raising web.HTTPError for error responses
+
+    See fetch() for *ttl* and *limiter*; other arguments are for HTTPRequest.
+    '''
+    # only GETs name a resource that may be gone
+    key = url if kwargs.get('method', 'GET') == 'GET' else None
+    if key is not None:
+      check_negative(key)
+    start_time = time.time()
+    res = await fetch(self.request(url, **kwargs), ttl=ttl, limiter=limiter,
+                      pool=self.pool, breaker=self.breaker_for(url))
+    base.STATSC.timing(self._metric, (time.time() - start_time) * 1000)
+    raise_for_status(key, res)
+    return res
+
+  async def get_text(self, url, **kwargs):
+    res = await self.fetch(url, **kwargs)
+    return res.body.decode('utf-8')
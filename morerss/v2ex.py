@@ -1,32 +1,32 @@
-from functools import partial
-
 import PyRSS2Gen
 from tornado import web
-from tornado.httpclient import AsyncHTTPClient
 from lxml.html import fromstring, tostring
 
 from .base import BaseHandler
-from . import base
+from . import base, upstream, render
 
-httpclient = AsyncHTTPClient()
+site = upstream.Site('v2ex')
 
 class V2exCommentHandler(BaseHandler):
+  cache_ttl = 600
+
   async def get(self, tid):
     url = 'https://www.v2ex.com/t/' + tid
-    webpage = await self._get_url(url)
+    webpage = await site.get_text(url)
 
     try:
-      data = parse_webpage(webpage, baseurl=url)
-
-      if len(data['comments']) < 40 and data['prev']:
-        webpage = await self._get_url(data['prev'])
-        data2 = parse_webpage(webpage, baseurl=data['prev'])
-        comments = data['comments'] + data2['comments']
-        if len(comments) > 40:
-          comments = comments[:40]
-      else:
-        comments = data['comments']
+      data = await render.run(parse_webpage, webpage, baseurl=url)
+      pages = [(webpage, url)]
+
+      comments = data['comments']
+      if len(comments) < 40 and data['prev']:
+        prev = data['prev']
+        webpage = await site.get_text(prev)
+        data2 = await render.run(parse_webpage, webpage, baseurl=prev)
+        pages.append((webpage, prev))
+        comments = (comments + data2['comments'])[:40]
     except PermissionError:
+      upstream.remember_negative(url, 403, 'login required')
       raise web.HTTPError(403, 'login required')
 
     rss_info = {
@@ -34,22 +34,16 @@ class V2exCommentHandler(BaseHandler):
       'description': data['description'],
     }
 
-    rss = base.data2rss(
-      url,
-      rss_info,
-      comments,
-      partial(comment2rss, url),
-    )
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
-
-  async def _get_url(self, url):
-    res = await httpclient.fetch(url, raise_error=False)
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
-    else:
-      res.rethrow()
-    return res.body.decode('utf-8')
+    validators = [data['subject'], data['description']]
+    validators.extend(comments)
+    if self.not_modified(validators):
+      return
+
+    items = []
+    for body, baseurl in pages:
+      items.extend(await render.run(page_items, body, baseurl, url))
+    xml = await render.feed(url, rss_info, items[:40])
+    await self.finish_feed(xml)
 
 def comment2rss(url, comment):
   rid = comment.get('id')
@@ -73,18 +67,23 @@ def comment2rss(url, comment):
   )
   return item
 
-def parse_webpage(body, baseurl):
+def _parse(body, baseurl):
   doc = fromstring(body, base_url=baseurl)
   doc.make_links_absolute()
+  comments = doc.xpath('//div[@id="Main"]/div[@class="box"]/div[@id]')
+  comments = comments[-40:]
+  comments.reverse()
+  return doc, comments
+
+def parse_webpage(body, baseurl):
+  '''Parse a topic page; comments are their ids'''
+  doc, comments = _parse(body, baseurl)
   subject = doc.xpath('//title')[0].text_content()
   if subject == 'V2EX › 登录':
     raise PermissionError
 
   description = doc.xpath('//meta[@property="og:description"]')[0] \
       .get('content')
-  comments = doc.xpath('//div[@id="Main"]/div[@class="box"]/div[@id]')
-  comments = comments[-40:]
-  comments.reverse()
   prev = doc.xpath('//link[@rel="prev"]')
   if prev:
     prev = prev[0].get('href')
@@ -94,10 +93,15 @@ def parse_webpage(body, baseurl):
   return {
     'subject': subject,
     'description': description,
-    'comments': comments,
+    'comments': [c.get('id') for c in comments],
     'prev': prev,
   }
 
+def page_items(body, baseurl, url=None):
+  '''The comments of a topic page as RSSItems linking to *url*'''
+  _, comments = _parse(body, baseurl)
+  return [comment2rss(url or baseurl, c) for c in comments]
+
 def test():
   import requests
 
@@ -114,8 +118,7 @@ def test():
   rss = base.data2rss(
     url,
     rss_info,
-    data['comments'],
-    partial(comment2rss, url),
+    page_items(r.text, baseurl=url),
   )
   return rss
 
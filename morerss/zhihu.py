@@ -3,80 +3,80 @@ import json
 from functools import partial
 import re
 import asyncio
-import os
 import logging
-import time
-import random
-import gzip
 
 import PyRSS2Gen
-from lxml.html import fromstring, tostring
 from tornado.options import options, define
 
 from .base import BaseHandler
 from . import base
+from . import cache
+from . import render
+from . import embedded
 from . import zhihulib
+from . import zhihu_store
+from . import zhihu_fetcher
 
 logger = logging.getLogger(__name__)
-define("cache-dir", default='/tmp/rss-cache',
-       help="cache directory for RSS data", type=str)
 
-_article_q = asyncio.Queue(maxsize=50)
-
-def _cache_filepath(id, updated):
-  a, b = divmod(id, 3000)
-  return f'{a}/{b}', f'{a}/{b}/{updated}.json.gz'
-
-def _save_article(doc):
-  fname = _cache_filepath(doc['id'], doc['updated'])[1]
-  path = os.path.join(options.cache_dir, fname)
-  os.makedirs(os.path.dirname(path), exist_ok=True)
-  with gzip.open(path, 'wt') as f:
-    json.dump(doc, f, ensure_ascii=False)
-
-async def _article_fetcher():
-  while True:
-    try:
-      id = await _article_q.get()
-      continue # no longer works
-      logger.info('fetching zhihu article %s', id)
-      start_time = time.time()
-      article = await zhihulib.fetch_article(id, pic=None)
-      used_time = time.time() - start_time
-      base.STATSC.timing('zhihu.fetch', used_time * 1000)
-      _save_article(article)
-      _article_q.task_done()
-    except Exception as e:
-      logger.error('error in _article_fetcher, sleeping 1s: %s', e)
-      time.sleep(random.randint(1, 5))
-    # else:
-    #   time.sleep(random.randint(50, 1000) / 1000)
-
-def article_from_cache(id, updated):
-  dirname = _cache_filepath(id, updated)[0]
-  dirname = os.path.join(options.cache_dir, dirname)
-  try:
-    times = [int(x.split('.', 1)[0]) for x in os.listdir(dirname)
-            if x.endswith(('.json', '.json.gz'))]
-  except FileNotFoundError:
-    return None
-
-  if not times:
-    return None
-
-  times.sort()
-  t = times[-1]
-  if t < updated:
-    return None
+define("zhihu-excerpt-cache-size", default=8,
+       help="maximum size of processed zhihu excerpts kept in memory in MiB", type=int)
+
+# excerpts are keyed by update time, so only the size cap matters
+_EXCERPT_TTL = 7 * 86400
+_excerpts = None
+
+def _excerpt(post, variant, body, pic):
+  '''*body* of *post* processed for *pic*, cached as *variant*'''
+  global _excerpts
+  if _excerpts is None:
+    _excerpts = cache.LRUCache(options.zhihu_excerpt_cache_size * 1024 * 1024)
+
+  key = post['id'], post['updated'], variant, pic
+  content = _excerpts.get(key)
+  if content is None:
+    content = zhihulib.process_content_for_html(body, pic=pic)
+    _excerpts.set(key, content, len(content), _EXCERPT_TTL)
+  return content
+
+def post_contents(posts, *, digest=False, pic=None, fullonly=False):
+  '''The content of each post by id, ready for the feed
+
+  Full texts with pictures proxied are made once and kept in the store;
+  processed excerpts are kept in memory. Posts left out of the feed for
+  *fullonly* are left out. Full texts not in the store are queued for
+  fetching.
+  '''
+  if digest:
+    return {p['id']: _excerpt(p, 'digest', p['excerpt'], pic) for p in posts}
+
+  store = zhihu_store.get_store()
+  wanted = {p['id']: p['updated'] for p in posts}
+  if pic:
+    full = store.get_variants(
+      wanted, pic,
+      lambda article: zhihulib.proxify_content(article['content'], pic))
+  else:
+    full = {id: article['content']
+            for id, article in store.get_many(wanted).items()}
 
-  try:
-    with gzip.open(f'{dirname}/{t}.json.gz', 'rt') as f:
-      return json.load(f)
-  except FileNotFoundError:
-    with open(f'{dirname}/{t}.json') as f:
-      return json.load(f)
+  contents = {}
+  for p in posts:
+    content = full.get(p['id'])
+    if content is not None:
+      base.STATSC.incr('zhihu.cache_hit')
+      contents[p['id']] = content
+    else:
+      base.STATSC.incr('zhihu.cache_miss')
+      zhihu_fetcher.request(str(p['id']))
+      if not fullonly:
+        contents[p['id']] = _excerpt(
+          p, 'excerpt', p['excerpt'] + ' (全文不可用)', pic)
+  return contents
 
 class ZhihuZhuanlanHandler(BaseHandler):
+  cache_args = ('pic', 'digest', 'fullonly')
+
   async def get(self, name):
     pic = self.get_argument('pic', None)
     digest = self.get_argument('digest', False) == 'true'
@@ -88,18 +88,23 @@ class ZhihuZhuanlanHandler(BaseHandler):
       return
 
     baseurl = 'https://zhuanlan.zhihu.com/' + name
-    res = await zhihulib.fetch_zhihu(baseurl)
-    if res.code == 302:
-      new_name = res.headers['Location'].rsplit('/', 1)[-1]
-      url = self.request.uri
-      self.redirect(re.sub(f'/{re.escape(name)}\\b', f'/{new_name}', url))
-      return
-
     url = 'https://zhuanlan.zhihu.com/api/columns/{}/articles?limit=20&include=data%5B*%5D.admin_closed_comment%2Ccomment_count%2Csuggest_edit%2Cis_title_image_full_screen%2Ccan_comment%2Cupvoted_followees%2Ccan_open_tipjar%2Ccan_tip%2Cvoteup_count%2Cvoting%2Ctopics%2Creview_info%2Cauthor.is_following%2Cis_labeled%2Clabel_info'.format(name)
-    posts = await self._get_url(url)
-
-    doc = fromstring(res.body.decode('utf-8'))
-    info = json.loads(doc.xpath('//script[@id="js-initialData"]')[0].text_content())
+    # fetch the articles while the column page is loading; they aren't
+    # needed if the column turns out to be renamed
+    posts_task = asyncio.ensure_future(self._get_url(url))
+    try:
+      res = await zhihulib.fetch_zhihu(baseurl)
+      if res.code == 302:
+        new_name = res.headers['Location'].rsplit('/', 1)[-1]
+        url = self.request.uri
+        self.redirect(re.sub(f'/{re.escape(name)}\\b', f'/{new_name}', url))
+        return
+      posts = await posts_task
+    finally:
+      base.discard(posts_task)
+
+    info = await render.run(
+      embedded.script_json, res.body, 'id', 'js-initialData')
     if info.get('spanName') == 'NotFoundErrorPage':
       self.set_status(404)
       self.set_header('Content-Type', 'text/plain')
@@ -114,53 +119,44 @@ class ZhihuZhuanlanHandler(BaseHandler):
       'description': description,
     }
 
-    rss = base.data2rss(
+    validators = [name, description, digest]
+    if digest:
+      saved = {}
+    else:
+      # full texts saved since the last request change the feed
+      saved = zhihu_store.get_store().newest(
+        {p['id']: p['updated'] for p in posts['data']})
+    validators.extend(
+      (p['id'], p['updated'], saved.get(p['id'])) for p in posts['data'])
+    if self.not_modified(validators):
+      return
+
+    contents = post_contents(
+      posts['data'], digest=digest, pic=pic, fullonly=fullonly)
+
+    xml = await render.feed(
       baseurl,
       rss_info, posts['data'],
-      partial(
-        post2rss, url,
-        digest = digest, pic = pic,
-        fullonly = fullonly,
-      ),
+      partial(post2rss, url, contents=contents),
     )
-    xml = rss.to_xml(encoding='utf-8')
-    self.finish(xml)
+    await self.finish_feed(xml)
 
   async def _get_url(self, url):
     res = await zhihulib.fetch_zhihu(url)
     info = json.loads(res.body.decode('utf-8'))
     return info
 
-def post2rss(baseurl, post, *, digest=False, pic=None, fullonly=False):
+def post2rss(baseurl, post, *, digest=False, pic=None, fullonly=False,
+             contents=None):
+  # contents: from post_contents() for the whole page at once; posts
+  # missing from it are left out
   url = post['url']
-  if digest:
-    content = post['excerpt']
-    content = zhihulib.process_content_for_html(content, pic=pic)
-  else:
-    article = article_from_cache(post['id'], post['updated'])
-    if not article:
-      base.STATSC.incr('zhihu.cache_miss')
-      try:
-        _article_q.put_nowait(str(post['id']))
-      except asyncio.QueueFull:
-        logger.warning('_article_q full')
-        base.STATSC.incr('zhihu.queue_full')
-
-      if fullonly:
-        return None
-
-      content = post['excerpt'] + ' (全文不可用)'
-      content = zhihulib.process_content_for_html(content, pic=pic)
-
-    else:
-      # logger.debug('cache hit for %s', post['id'])
-      base.STATSC.incr('zhihu.cache_hit')
-
-      content = article['content']
-      if pic:
-        doc = fromstring(content)
-        base.proxify_pic(doc, zhihulib.re_zhihu_img, pic)
-        content = tostring(doc, encoding=str)
+  if contents is None:
+    contents = post_contents(
+      [post], digest=digest, pic=pic, fullonly=fullonly)
+  content = contents.get(post['id'])
+  if content is None:
+    return None
 
   if post.get('title_image'):
     content = '<p><img src="%s"></p>' % post['title_image'] + content
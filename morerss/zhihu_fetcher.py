@@ -0,0 +1,127 @@
+'''Fetching full texts of Zhihu articles in background.
+
+Column feeds only get excerpts from the API. Articles missing from the
+store are queued by request(), and --zhihu-article-workers workers fetch
+them from the --zhihu-article-source and save them to the store. The
+queue is kept in the store too (see zhihu_store.FetchQueue), so a backlog
+is worked through across restarts.
+'''
+
+import time
+import random
+import asyncio
+import logging
+
+from tornado.options import options, define
+
+from . import base
+from . import render
+from . import zhihulib
+from . import zhihu_store
+
+define("zhihu-article-workers", default=0,
+       help="workers fetching full texts of zhihu articles, 0 to disable", type=int)
+define("zhihu-article-retry", default=600.0,
+       help="seconds before fetching a zhihu article again after a failure; doubled for each attempt", type=float)
+define("zhihu-article-max-attempts", default=5,
+       help="times to try fetching a zhihu article before giving up", type=int)
+define("zhihu-article-source", default='page',
+       help="where full texts of zhihu articles come from; see SOURCES", type=str)
+
+logger = logging.getLogger(__name__)
+
+class ArticleSource:
+  '''Where full texts of articles come from'''
+  async def fetch(self, id):
+    '''Return the article *id* (a str) as a dict like the store keeps'''
+    raise NotImplementedError
+
+class PageSource(ArticleSource):
+  '''The data embedded in the article page'''
+  async def fetch(self, id):
+    return await zhihulib.fetch_article(id, pic=None)
+
+# --zhihu-article-source -> ArticleSource class
+SOURCES = {
+  'page': PageSource,
+}
+
+class ArticleFetcher:
+  # seconds to pause a worker after a failure, doubled for each one in a row
+  backoff = 1
+  max_backoff = 300
+
+  def __init__(self, source, workers, queue):
+    self.source = source
+    self.workers = workers
+    self.queue = queue
+    self._tasks = []
+
+  def request(self, id):
+    '''Ask for the full text of article *id* (a str)'''
+    if not self.workers:
+      return
+    self.queue.put(id)
+
+  def start(self):
+    for i in range(self.workers):
+      self._tasks.append(asyncio.ensure_future(self._work(i)))
+
+  async def _work(self, n):
+    failures = 0
+    while True:
+      id, queued_at, attempts = await self.queue.get()
+      base.STATSC.gauge('zhihu.article_queue.depth', len(self.queue))
+      base.STATSC.timing('zhihu.article_queue.age',
+                         (time.time() - queued_at) * 1000)
+      try:
+        logger.info('fetching zhihu article %s', id)
+        start_time = time.time()
+        article = await self.source.fetch(id)
+        used_time = time.time() - start_time
+        base.STATSC.timing('zhihu.fetch', used_time * 1000)
+        # made now so that serving the article doesn't have to
+        variants = await render.run(
+          zhihulib.content_variants, article['content'])
+        zhihu_store.get_store().save(article, variants)
+      except asyncio.CancelledError:
+        # fetched again later, maybe after a restart
+        self.queue.release(id)
+        raise
+      except Exception as e:
+        base.STATSC.incr('zhihu.article_failed')
+        retry = options.zhihu_article_retry * 2 ** attempts
+        if not self.queue.failed(
+          id, retry, options.zhihu_article_max_attempts):
+          logger.warning('giving up zhihu article %s', id)
+
+        delay = min(self.backoff * 2 ** failures, self.max_backoff)
+        delay *= random.uniform(0.5, 1.5)
+        failures += 1
+        logger.error('worker %d failed to fetch zhihu article %s, '
+                     'sleeping %.1fs: %s', n, id, delay, e)
+        await asyncio.sleep(delay)
+      else:
+        self.queue.done(id)
+        base.STATSC.incr('zhihu.article_fetched')
+        failures = 0
+
+_fetcher = None
+
+def get_fetcher():
+  global _fetcher
+  if _fetcher is None:
+    try:
+      source = SOURCES[options.zhihu_article_source]()
+    except KeyError:
+      raise ValueError('unknown zhihu article source: %r'
+                       % options.zhihu_article_source)
+    _fetcher = ArticleFetcher(
+      source,
+      options.zhihu_article_workers,
+      zhihu_store.get_store().queue,
+    )
+  return _fetcher
+
+def request(id):
+  get_fetcher().request(id)
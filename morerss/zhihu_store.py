@@ -0,0 +1,310 @@
+'''Full-text Zhihu articles, kept in one SQLite database under --cache-dir.
+
+Every saved version of an article is a row keyed by (id, updated). The
+newest updated time of every id is also kept in memory, so lookups for
+articles we don't have never touch the database, and the ones we have are
+read by primary key.
+
+Variants of the content of an article, e.g. with pictures proxied, are
+kept keyed by (id, updated, variant), so that they are made only once.
+
+The same database keeps the queue of articles to fetch, see FetchQueue.
+'''
+
+import os
+import gzip
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+
+from tornado.options import options
+
+from . import base
+
+logger = logging.getLogger(__name__)
+
+# the highest SQLite host parameter count on old versions
+_MAX_PARAMS = 999
+
+class ArticleStore:
+  def __init__(self, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self._db = sqlite3.connect(path, isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS articles (
+      id INTEGER NOT NULL,
+      updated INTEGER NOT NULL,
+      doc BLOB NOT NULL,
+      PRIMARY KEY (id, updated)
+    ) WITHOUT ROWID''')
+    self._db.execute('''CREATE TABLE IF NOT EXISTS article_variants (
+      id INTEGER NOT NULL,
+      updated INTEGER NOT NULL,
+      variant TEXT NOT NULL,
+      content BLOB NOT NULL,
+      PRIMARY KEY (id, updated, variant)
+    ) WITHOUT ROWID''')
+    # id -> newest updated time saved
+    self._newest = {}
+    self.queue = FetchQueue(self._db)
+
+  def build_index(self):
+    '''Load the newest version of every article into memory
+
+    Articles saved by other processes afterwards are not seen.
+    '''
+    start_time = time.time()
+    self._newest = dict(self._db.execute(
+      'SELECT id, MAX(updated) FROM articles GROUP BY id'))
+    used_time = time.time() - start_time
+    base.STATSC.timing('zhihu.article_index.build', used_time * 1000)
+    base.STATSC.gauge('zhihu.article_index.size', len(self._newest))
+    logger.info('indexed %d zhihu articles in %.3fs',
+                len(self._newest), used_time)
+
+  def save(self, doc, variants=None):
+    '''Save article *doc*, with *variants* of its content by name if given'''
+    id = int(doc['id'])
+    blob = gzip.compress(json.dumps(doc, ensure_ascii=False).encode('utf-8'))
+    self._db.execute('BEGIN')
+    try:
+      self._db.execute(
+        'INSERT OR REPLACE INTO articles VALUES (?, ?, ?)',
+        (id, doc['updated'], blob),
+      )
+      for variant, content in (variants or {}).items():
+        self._save_variant(id, doc['updated'], variant, content)
+    except BaseException:
+      self._db.execute('ROLLBACK')
+      raise
+    self._db.execute('COMMIT')
+    if doc['updated'] >= self._newest.get(id, doc['updated']):
+      self._newest[id] = doc['updated']
+      base.STATSC.gauge('zhihu.article_index.size', len(self._newest))
+
+  def get(self, id, updated):
+    '''The newest article saved for *id* if it's at least as new as *updated*'''
+    newest = self._newest.get(id)
+    if newest is None or newest < updated:
+      return None
+    row = self._db.execute(
+      'SELECT doc FROM articles WHERE id = ? AND updated = ?', (id, newest),
+    ).fetchone()
+    if row is None:
+      return None
+    return _load(row[0])
+
+  def get_many(self, wanted):
+    '''Like get() for a mapping of ids to updated times
+
+    Returns a mapping of ids to articles, for those available.
+    '''
+    return self._get_many(self._hits(wanted))
+
+  def newest(self, wanted):
+    '''Like get_many(), but only the updated times of the articles'''
+    return dict(self._hits(wanted))
+
+  def get_variants(self, wanted, variant, make):
+    '''Like get_many(), but for the content variant *variant* of the articles
+
+    Variants not saved yet are made with ``make(article)`` and saved.
+    Returns a mapping of ids to contents.
+    '''
+    hits = self._hits(wanted)
+    found = {}
+    # two parameters per article, and one for the variant
+    step = (_MAX_PARAMS - 1) // 2
+    for i in range(0, len(hits), step):
+      chunk = hits[i:i+step]
+      rows = self._db.execute(
+        'SELECT id, content FROM article_variants WHERE variant = ? AND (%s)'
+        % ' OR '.join(['(id = ? AND updated = ?)'] * len(chunk)),
+        [variant, *(x for hit in chunk for x in hit)],
+      )
+      for id, content in rows:
+        found[id] = gzip.decompress(content).decode('utf-8')
+
+    missing = [hit for hit in hits if hit[0] not in found]
+    for id, article in self._get_many(missing).items():
+      content = found[id] = make(article)
+      self._save_variant(id, article['updated'], variant, content)
+    return found
+
+  def _hits(self, wanted):
+    '''(id, newest updated time) of the wanted articles available'''
+    hits = []
+    for id, updated in wanted.items():
+      newest = self._newest.get(id)
+      if newest is not None and newest >= updated:
+        hits.append((id, newest))
+    return hits
+
+  def _get_many(self, hits):
+    found = {}
+    # two parameters per article
+    step = _MAX_PARAMS // 2
+    for i in range(0, len(hits), step):
+      chunk = hits[i:i+step]
+      rows = self._db.execute(
+        'SELECT id, doc FROM articles WHERE %s' % ' OR '.join(
+          ['(id = ? AND updated = ?)'] * len(chunk)),
+        [x for hit in chunk for x in hit],
+      )
+      for id, doc in rows:
+        found[id] = _load(doc)
+    return found
+
+  def _save_variant(self, id, updated, variant, content):
+    self._db.execute(
+      'INSERT OR REPLACE INTO article_variants VALUES (?, ?, ?, ?)',
+      (id, updated, variant, gzip.compress(content.encode('utf-8'))),
+    )
+
+  def migrate_from_tree(self, cache_dir):
+    '''Import articles from the old {id//3000}/{id%3000}/{updated}.json.gz tree
+
+    This only runs once per database; the old files are left in place.
+    '''
+    if self._db.execute('PRAGMA user_version').fetchone()[0] >= 1:
+      return
+
+    n = 0
+    self._db.execute('BEGIN')
+    for a in _scan_digits(cache_dir):
+      for b in _scan_digits(a.path):
+        id = int(a.name) * 3000 + int(b.name)
+        for f in os.scandir(b.path):
+          updated, _, ext = f.name.partition('.')
+          if not updated.isdigit() or ext not in ('json', 'json.gz'):
+            continue
+          with open(f.path, 'rb') as fp:
+            blob = fp.read()
+          if ext == 'json':
+            blob = gzip.compress(blob)
+          self._db.execute(
+            'INSERT OR IGNORE INTO articles VALUES (?, ?, ?)',
+            (id, int(updated), blob),
+          )
+          n += 1
+    self._db.execute('PRAGMA user_version = 1')
+    self._db.execute('COMMIT')
+    if n:
+      logger.info('imported %d zhihu articles from %s', n, cache_dir)
+
+class FetchQueue:
+  '''Article ids waiting to be fetched, most wanted first.
+
+  The queue survives restarts and has no size limit. Each id is queued
+  once; asking for it again raises its priority. Failed fetches are
+  retried later, up to a number of attempts.
+  '''
+  def __init__(self, db):
+    self._db = db
+    db.execute('''CREATE TABLE IF NOT EXISTS fetch_queue (
+      id TEXT PRIMARY KEY,
+      demand INTEGER NOT NULL,
+      queued REAL NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt REAL NOT NULL
+    )''')
+    db.execute('''CREATE INDEX IF NOT EXISTS fetch_queue_order
+      ON fetch_queue (demand DESC, queued)''')
+    # ids being fetched by this process
+    self._in_flight = set()
+    self._wakeup = asyncio.Event()
+
+  def __len__(self):
+    return self._db.execute('SELECT COUNT(*) FROM fetch_queue').fetchone()[0]
+
+  def put(self, id):
+    now = time.time()
+    self._db.execute(
+      '''INSERT INTO fetch_queue (id, demand, queued, next_attempt)
+      VALUES (?, 1, ?, ?)
+      ON CONFLICT (id) DO UPDATE SET demand = demand + 1''',
+      (id, now, now),
+    )
+    self._wakeup.set()
+
+  async def get(self):
+    '''Wait for the most wanted id due for fetching
+
+    Returns the id, the time it was first queued and the attempts made.
+    Call done() or failed() with it afterwards.
+    '''
+    while True:
+      now = time.time()
+      skip = ','.join('?' * len(self._in_flight))
+      row = self._db.execute(
+        '''SELECT id, queued, attempts FROM fetch_queue
+        WHERE next_attempt <= ? AND id NOT IN (%s)
+        ORDER BY demand DESC, queued LIMIT 1''' % skip,
+        (now, *self._in_flight),
+      ).fetchone()
+      if row is not None:
+        self._in_flight.add(row[0])
+        return row
+
+      due = self._db.execute(
+        'SELECT MIN(next_attempt) FROM fetch_queue WHERE id NOT IN (%s)' % skip,
+        tuple(self._in_flight),
+      ).fetchone()[0]
+      self._wakeup.clear()
+      try:
+        await asyncio.wait_for(
+          self._wakeup.wait(), None if due is None else due - now)
+      except asyncio.TimeoutError:
+        pass
+
+  def done(self, id):
+    self._db.execute('DELETE FROM fetch_queue WHERE id = ?', (id,))
+    self._in_flight.discard(id)
+
+  def release(self, id):
+    '''Leave *id* for later without counting an attempt'''
+    self._in_flight.discard(id)
+    self._wakeup.set()
+
+  def failed(self, id, retry_after, max_attempts):
+    '''Retry *id* after *retry_after* seconds, unless it's been tried too often
+
+    Returns whether it will be retried.
+    '''
+    self._in_flight.discard(id)
+    self._db.execute(
+      '''UPDATE fetch_queue SET attempts = attempts + 1, next_attempt = ?
+      WHERE id = ?''',
+      (time.time() + retry_after, id),
+    )
+    row = self._db.execute(
+      'SELECT attempts FROM fetch_queue WHERE id = ?', (id,)).fetchone()
+    if row is None:
+      return False
+    if row[0] < max_attempts:
+      return True
+    self._db.execute('DELETE FROM fetch_queue WHERE id = ?', (id,))
+    return False
+
+def _scan_digits(path):
+  try:
+    return [d for d in os.scandir(path) if d.name.isdigit() and d.is_dir()]
+  except FileNotFoundError:
+    return []
+
+def _load(blob):
+  return json.loads(gzip.decompress(blob))
+
+_store = None
+
+def get_store():
+  global _store
+  if _store is None:
+    _store = ArticleStore(
+      os.path.join(options.cache_dir, 'zhihu_articles.sqlite3'))
+    _store.migrate_from_tree(options.cache_dir)
+    _store.build_index()
+  return _store
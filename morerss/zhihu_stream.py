@@ -3,6 +3,8 @@ import json
 import datetime
 import logging
 from functools import partial
+from contextlib import aclosing
+import asyncio
 import time
 
 import tornado.httpclient
@@ -10,13 +12,27 @@ from tornado import web
 import PyRSS2Gen
 from lxml.html import fromstring, tostring
 
-from . import base
-from .zhihulib import fetch_zhihu, re_zhihu_img, tidy_content
+from . import base, upstream, render
+from .zhihulib import fetch_zhihu, get_rewriter
 
 logger = logging.getLogger(__name__)
 
 ACCEPT_VERBS = ['MEMBER_CREATE_ARTICLE', 'ANSWER_CREATE']
 VOTEUP_VERBS = ['MEMBER_VOTEUP_ARTICLE', 'ANSWER_VOTE_UP']
+# items wanted in a feed, and pages to follow after the first to get them
+FEED_ITEMS = 20
+FEED_PAGES = 3
+# seconds to cache profiles and topic / collection / question info,
+# which are fetched for every render but rarely change
+INFO_TTL = 3600
+
+def negative_key(kind, id):
+  '''The key a gone or forbidden member, topic, etc. is remembered by
+
+  Its list URLs change with every request, so they won't do. Check it
+  before fetching anything for a feed.
+  '''
+  return 'zhihu:%s:%s' % (kind, id)
 
 class ZhihuAPI:
   user_agent = 'Mozilla/5.0 (X11; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0'
@@ -34,7 +50,8 @@ class ZhihuAPI:
       'limit': '7',
     }
     url += '?' + urlencode(query)
-    data = await self.get_json(url, api_version='v3')
+    data = await self.get_json(
+      url, api_version='v3', negative_key=negative_key('member', name))
     return data
 
   async def pins(self, name):
@@ -50,7 +67,7 @@ class ZhihuAPI:
       'limit': '7',
     }
     url += '?' + urlencode(query)
-    data = await self.get_json(url)
+    data = await self.get_json(url, negative_key=negative_key('member', name))
     return data
 
   async def collection_contents(self, id):
@@ -61,7 +78,8 @@ class ZhihuAPI:
       'limit': '7',
     }
     url += '?' + urlencode(query)
-    data = await self.get_json(url)
+    data = await self.get_json(
+      url, negative_key=negative_key('collection', id))
     return data
 
   async def topic(self, id, sort='hot'):
@@ -81,7 +99,7 @@ class ZhihuAPI:
       'limit': '7',
     }
     url += '?' + urlencode(query)
-    data = await self.get_json(url)
+    data = await self.get_json(url, negative_key=negative_key('topic', id))
     return data
 
   async def answers(self, id, sort='created'):
@@ -92,10 +110,68 @@ class ZhihuAPI:
       'limit': '7',
     }
     url += '&' + urlencode(query)
-    data = await self.get_json(url)
+    data = await self.get_json(
+      url, negative_key=negative_key('question', id))
     return data
 
-  async def get_json(self, url, api_version='v4'):
+  async def pages(self, first, *, max_pages=FEED_PAGES, next_url=None,
+                  enough=None):
+    """
+    Iterate over the data of a paged API response and the pages after it
+    :param first (awaitable): the first response, e.g. self.activities(name)
+    :param max_pages (int): how many pages to follow after the first one
+    :param next_url (callable): fixes up paging.next URLs if given
+    :param enough (callable): called with each page's data before the next
+      page is requested; no more pages are requested once it returns True
+
+    The next page is requested before the current one is yielded, so that
+    it loads while the caller processes this one; never more than one page
+    ahead. Wrap the iterator in contextlib.aclosing() if the caller may stop
+    early, so that it stops waiting for that page. The request itself still
+    completes, so pass *enough* rather than stopping early when possible.
+    """
+    data = await first
+    budget = max_pages
+    pending = None
+    try:
+      while True:
+        paging = data.get('paging') or {}
+        done = enough is not None and enough(data['data'])
+        if not done and not paging.get('is_end', True) and budget > 0:
+          url = paging['next']
+          if next_url:
+            url = next_url(url)
+          budget -= 1
+          pending = asyncio.ensure_future(self.get_json(url))
+        yield data['data']
+
+        if pending is None:
+          break
+        data = await pending
+        pending = None
+    finally:
+      if pending is not None:
+        base.discard(pending)
+
+  async def collect(self, first, transform, *, limit=FEED_ITEMS, **kwargs):
+    """
+    Gather items from paged API responses until there are enough
+    :param first (awaitable): the first response
+    :param transform (callable): maps a page's data to the items wanted from it
+    :param limit (int): stop following pages once this many items are found
+    :return (list): the items, possibly more than limit
+    """
+    items = []
+    def enough(data):
+      items.extend(transform(data))
+      return len(items) >= limit
+
+    async with aclosing(self.pages(first, enough=enough, **kwargs)) as pages:
+      async for _ in pages:
+        pass
+    return items
+
+  async def get_json(self, url, api_version='v4', ttl=None, negative_key=None):
     baseurl = 'https://www.zhihu.com/api/%s/' % (api_version)
     url = urljoin(baseurl, url)
     headers = {
@@ -104,7 +180,8 @@ class ZhihuAPI:
       'x-api-version': '3.0.40',
       'x-udid': 'AMAiMrPqqQ2PTnOxAr5M71LCh-dIQ8kkYvw=',
     }
-    res = await fetch_zhihu(url, headers = headers)
+    res = await fetch_zhihu(url, headers = headers, ttl = ttl,
+                            negative_key = negative_key)
     return json.loads(res.body.decode('utf-8'))
 
   async def card(self, name):
@@ -117,10 +194,13 @@ class ZhihuAPI:
       json.dumps({
         'url_token': name,
       })))
+    key = negative_key('member', name)
     res = await fetch_zhihu(
-      url, headers = {'User-Agent': self.user_agent})
+      url, headers = {'User-Agent': self.user_agent}, ttl = INFO_TTL,
+      negative_key = key)
     if not res.body:
       # e.g. https://www.zhihu.com/bei-feng-san-dai
+      upstream.remember_negative(key, 404)
       raise web.HTTPError(404)
     doc = fromstring(res.body.decode('utf-8'))
     name = doc.xpath('//span[@class="name"]')[0].text_content()
@@ -148,9 +228,12 @@ class ZhihuAPI:
 
     url = urljoin('https://www.zhihu.com/topic/', id)
 
+    key = negative_key('topic', id)
     resp = await fetch_zhihu(
-      url, headers={'User-Agent': self.user_agent})
+      url, headers={'User-Agent': self.user_agent}, ttl=INFO_TTL,
+      negative_key=key)
     if not resp.body:
+      upstream.remember_negative(key, 404)
       raise web.HTTPError(404)
     doc = fromstring(resp.body.decode('utf-8'))
 
@@ -178,7 +261,8 @@ class ZhihuAPI:
     :return (dict): dict containing the collection's title, description, creator and URL
     """
     url = 'collections/%s' % id
-    data = await self.get_json(url)
+    data = await self.get_json(
+      url, ttl=INFO_TTL, negative_key=negative_key('collection', id))
     collection_data = data['collection']
 
     return {
@@ -195,7 +279,8 @@ class ZhihuAPI:
     :return (dict): dict containing the question's title and URL
     """
     url = 'https://api.zhihu.com/questions/%s?include=detail' % id
-    data = await self.get_json(url)
+    data = await self.get_json(
+      url, ttl=INFO_TTL, negative_key=negative_key('question', id))
 
     return {
       'title': data['title'],
@@ -205,86 +290,87 @@ class ZhihuAPI:
 
 zhihu_api = ZhihuAPI()
 
-async def activities2rss(name, digest=False, pic=None):
-  info = await zhihu_api.card(name)
+async def activities2rss(name, digest=False, pic=None, not_modified=None):
+  upstream.check_negative(negative_key('member', name))
+  info, posts, pins_data = await base.gather(
+    zhihu_api.card(name),
+    _activity_posts(name),
+    zhihu_api.pins(name),
+  )
   url = info['url']
   info = {
     'title': '%s - 知乎动态' % info['name'],
     'description': info['headline'],
   }
 
-  posts = []
-  page = 0
-
-  data = await zhihu_api.activities(name)
-  posts = [x['target'] for x in data['data'] if x['verb'] in ACCEPT_VERBS]
-
-  while len(posts) < 20 and page < 3:
-    paging = data['paging']
-    # logger.debug('paging: %r', paging)
-    if paging['is_end']:
-      break
-    data = await zhihu_api.get_json(paging['next'])
-    posts.extend(
-      x['target'] for x in data['data'] if x['verb'] in ACCEPT_VERBS
-    )
-    page += 1
-
-  pins_data = await zhihu_api.pins(name)
   pins = [pin for pin in pins_data['data']]
 
   posts = sorted(pins + posts, reverse=True, key=lambda t: t['created_time'] if t.get('created_time') else t['created'])
 
-  rss = base.data2rss(
+  if feed_not_modified(not_modified, info, posts):
+    return None
+
+  xml = await render.feed(
     url,
     info, posts,
     partial(post2rss, digest=digest, pic=pic),
   )
-  xml = rss.to_xml(encoding='utf-8')
   return xml
 
+def _activity_posts(name):
+  return zhihu_api.collect(
+    zhihu_api.activities(name),
+    lambda data: [x['target'] for x in data if x['verb'] in ACCEPT_VERBS],
+  )
+
 
-async def upvote2rss(name, digest=False, pic=None):
-  info = await zhihu_api.card(name)
+async def upvote2rss(name, digest=False, pic=None, not_modified=None):
+  upstream.check_negative(negative_key('member', name))
+  info, vote_ups = await base.gather(
+    zhihu_api.card(name),
+    _vote_ups(name),
+  )
   url = info['url']
   info = {
     'title': '%s - 知乎赞同' % info['name'],
     'description': info['headline'],
   }
 
-  page = 0
+  if feed_not_modified(not_modified, info, vote_ups):
+    return None
+
+  xml = await render.feed(
+    url,
+    info, vote_ups,
+    partial(post2rss, digest=digest, pic=pic),
+  )
+  return xml
 
-  data = await zhihu_api.activities(name)
+def _vote_ups(name):
+  return zhihu_api.collect(zhihu_api.activities(name), _vote_up_targets)
 
+def _vote_up_targets(data):
   vote_ups = []
-  for x in data['data']:
+  for x in data:
     if x['verb'] in VOTEUP_VERBS:
       x['target']['type'] = x['verb']
       x['target']['vote_up_time'] = x['created_time']
       vote_ups.append(x['target'])
+  return vote_ups
 
-  while len(vote_ups) < 20 and page < 3:
-    paging = data['paging']
-    # logger.debug('paging: %r', paging)
-    if paging['is_end']:
-      break
-    data = await zhihu_api.get_json(paging['next'])
 
-    for x in data['data']:
-      if x['verb'] in VOTEUP_VERBS:
-        x['target']['type'] = x['verb']
-        x['target']['vote_up_time'] = x['created_time']
-        vote_ups.append(x['target'])
+def post_validator(post):
+  '''The identity and version of a post, for conditional GET'''
+  return tuple(post.get(k) for k in (
+    'type', 'id', 'updated_time', 'updated', 'vote_up_time'))
 
-    page += 1
-
-  rss = base.data2rss(
-    url,
-    info, vote_ups,
-    partial(post2rss, digest=digest, pic=pic),
-  )
-  xml = rss.to_xml(encoding='utf-8')
-  return xml
+def feed_not_modified(not_modified, info, posts):
+  '''Call a handler's not_modified with validators for Zhihu posts'''
+  if not_modified is None:
+    return False
+  validators = [info['title'], info['description']]
+  validators.extend(post_validator(post) for post in posts)
+  return not_modified(validators)
 
 
 def pin_content(pin):
@@ -422,17 +508,12 @@ def post2rss(post, digest=False, pic=None, extra_types=()):
   else:
     pass
 
-  content = content.replace('<code ', '<pre><code ')
-  content = content.replace('</code>', '</code></pre>')
-
   # Post only contains images but no text
   if not content:
     content = '<img src="%s">' % post.get('thumbnail')
 
   doc = fromstring(content)
-  tidy_content(doc)
-  if pic:
-    base.proxify_pic(doc, re_zhihu_img, pic)
+  doc = get_rewriter(tidy=True, code=True, pic=pic)(doc)
   content = tostring(doc, encoding=str)
 
   pub_date = datetime.datetime.utcfromtimestamp(t_c)
@@ -448,45 +529,45 @@ def post2rss(post, digest=False, pic=None, extra_types=()):
   return item
 
 
-async def collection2rss(id, pic=None):
-  info = await zhihu_api.collection_info(id)
+async def collection2rss(id, pic=None, not_modified=None):
+  upstream.check_negative(negative_key('collection', id))
+  info, collection_contents = await base.gather(
+    zhihu_api.collection_info(id),
+    zhihu_api.collect(
+      zhihu_api.collection_contents(id), _collected_contents),
+  )
   url = info['url']
   info = {
     'title': '%s - %s 的知乎收藏夹' % (info['title'], info['creator']['name']),
     'description': info['description'],
   }
 
-  page = 0
-  data = await zhihu_api.collection_contents(id)
+  if feed_not_modified(not_modified, info, collection_contents):
+    return None
 
-  collection_contents = []
-  for x in data['data']:
-    x['content']['type'] = 'MEMBER_COLLECT_' + x['content']['type'].upper()
-    collection_contents.append(x['content'])
-
-  while len(collection_contents) < 20 and page < 3:
-    paging = data['paging']
-    # logger.debug('paging: %r', paging)
-    if paging['is_end']:
-      break
-    next_url = paging['next']
-    data = await zhihu_api.get_json(next_url)
-    for x in data['data']:
-      x['content']['type'] = 'MEMBER_COLLECT_' + x['content']['type'].upper()
-      collection_contents.append(x['content'])
-    page += 1
-
-  rss = base.data2rss(
+  xml = await render.feed(
     url,
     info, collection_contents,
     partial(post2rss, pic=pic)
   )
-  xml = rss.to_xml(encoding='utf-8')
   return xml
 
-
-async def topic2rss(id, sort='hot', pic=None):
-  info = await zhihu_api.topic_info(id)
+def _collected_contents(data):
+  for x in data:
+    x['content']['type'] = 'MEMBER_COLLECT_' + x['content']['type'].upper()
+  return [x['content'] for x in data]
+
+
+async def topic2rss(id, sort='hot', pic=None, not_modified=None):
+  upstream.check_negative(negative_key('topic', id))
+  info, posts = await base.gather(
+    zhihu_api.topic_info(id),
+    zhihu_api.collect(
+      _topic_first_page(id, sort),
+      lambda data: [x['target'] for x in data],
+      next_url = _topic_next_url,
+    ),
+  )
   url = info.get('url')
   if sort == 'hot':
     title = '%s - 知乎话题 - 热门排序 ' % info.get('name')
@@ -497,39 +578,38 @@ async def topic2rss(id, sort='hot', pic=None):
     'description': info.get('description')
   }
 
-  page = 0
-  data = await zhihu_api.topic(id, sort)
-  if error := data.get('error'):
-    raise Exception(error['message'])
+  if feed_not_modified(not_modified, info, posts):
+    return None
 
-  posts = [x['target'] for x in data['data']]
-
-  while len(posts) < 20 and page < 3:
-    paging = data['paging']
-    # logger.debug('paging: %r', paging)
-    if paging['is_end']:
-      break
-    next_url = paging['next']
-    next_url = next_url.replace('https://www.zhihu.com/topics/', 'https://www.zhihu.com/api/v4/topics/')
-    next_url = next_url.replace('timeline_activity_no_video', 'timeline_activity')
-    data = await zhihu_api.get_json(next_url)
-    posts.extend(
-      x['target'] for x in data['data']
-    )
-    page += 1
-
-  rss = base.data2rss(
+  xml = await render.feed(
     url,
     info, posts,
     # include question posts
     partial(post2rss, pic=pic, extra_types=('question'))
   )
-  xml = rss.to_xml(encoding='utf-8')
   return xml
 
-
-async def question2rss(id, sort='created', pic=None):
-  info = await zhihu_api.question_info(id)
+async def _topic_first_page(id, sort):
+  data = await zhihu_api.topic(id, sort)
+  if error := data.get('error'):
+    raise Exception(error['message'])
+  return data
+
+def _topic_next_url(next_url):
+  next_url = next_url.replace('https://www.zhihu.com/topics/', 'https://www.zhihu.com/api/v4/topics/')
+  next_url = next_url.replace('timeline_activity_no_video', 'timeline_activity')
+  return next_url
+
+
+async def question2rss(id, sort='created', pic=None, not_modified=None):
+  upstream.check_negative(negative_key('question', id))
+  info, answers = await base.gather(
+    zhihu_api.question_info(id),
+    zhihu_api.collect(
+      _answers_first_page(id, sort),
+      lambda data: [{**x, 'type': 'QUESTION_ANSWER'} for x in data],
+    ),
+  )
   url = info['url']
 
   if sort == 'created':
@@ -542,33 +622,27 @@ async def question2rss(id, sort='created', pic=None):
     'description': info['description']
   }
 
-  page = 0
-  data = await zhihu_api.answers(id, sort)
+  if feed_not_modified(not_modified, info, answers):
+    return None
 
-  if err := data.get('error'):
-    raise web.HTTPError(503, '知乎报错：' + err['message'])
-  answers = [{**x, 'type': 'QUESTION_ANSWER'} for x in data['data']]
-
-  while len(answers) < 20 and page < 3:
-    paging = data['paging']
-    if paging['is_end']:
-      break
-    next_url = paging['next']
-    data = await zhihu_api.get_json(next_url)
-    answers.extend({**x, 'type': 'QUESTION_ANSWER'} for x in data['data'])
-    page += 1
-
-  rss = base.data2rss(
+  xml = await render.feed(
     url,
     info, answers,
     partial(post2rss, pic=pic)
   )
-  xml = rss.to_xml(encoding='utf-8')
 
   return xml
 
+async def _answers_first_page(id, sort):
+  data = await zhihu_api.answers(id, sort)
+  if err := data.get('error'):
+    raise web.HTTPError(503, '知乎报错：' + err['message'])
+  return data
+
 
 class ZhihuStream(base.BaseHandler):
+  cache_args = ('pic', 'digest')
+
   async def get(self, name):
     if name.endswith(' '):
       raise web.HTTPError(404)
@@ -577,10 +651,14 @@ class ZhihuStream(base.BaseHandler):
     pic = self.get_argument('pic', None)
     digest = self.get_argument('digest', False) == 'true'
 
-    rss = await activities2rss(name, digest=digest, pic=pic)
-    self.finish(rss)
+    rss = await activities2rss(name, digest=digest, pic=pic,
+                               not_modified=self.not_modified)
+    if rss is not None:
+      await self.finish_feed(rss)
 
 class ZhihuTopic(base.BaseHandler):
+  cache_args = ('sort', 'pic')
+
   async def get(self, id):
     """
     :param id (str): Zhihu topic id, as "19551894" in "https://www.zhihu.com/topic/19551894/hot"
@@ -595,25 +673,32 @@ class ZhihuTopic(base.BaseHandler):
       sort = 'hot'
     pic = self.get_argument('pic', None)
     try:
-      rss = await topic2rss(id, sort=sort, pic=pic)
+      rss = await topic2rss(id, sort=sort, pic=pic,
+                            not_modified=self.not_modified)
     except Exception as e:
       self.set_status(500)
       self.set_header('Content-Type', 'text/plain; charset=utf-8')
       self.finish(str(e))
       return
-    self.finish(rss)
+    if rss is not None:
+      await self.finish_feed(rss)
 
 class ZhihuCollectionHandler(base.BaseHandler):
+  cache_args = ('pic',)
+
   async def get(self, id):
     if id.endswith(' '):
       raise web.HTTPError(404)
 
     pic = self.get_argument('pic', None)
-    rss = await collection2rss(id, pic=pic)
+    rss = await collection2rss(id, pic=pic, not_modified=self.not_modified)
 
-    self.finish(rss)
+    if rss is not None:
+      await self.finish_feed(rss)
 
 class ZhihuUpvoteHandler(base.BaseHandler):
+  cache_args = ('pic', 'digest')
+
   async def get(self, name):
     if name.endswith(' '):
       raise web.HTTPError(404)
@@ -623,11 +708,15 @@ class ZhihuUpvoteHandler(base.BaseHandler):
     pic = self.get_argument('pic', None)
     digest = self.get_argument('digest', False) == 'true'
 
-    rss = await upvote2rss(name, digest=digest, pic=pic)
+    rss = await upvote2rss(name, digest=digest, pic=pic,
+                           not_modified=self.not_modified)
 
-    self.finish(rss)
+    if rss is not None:
+      await self.finish_feed(rss)
 
 class ZhihuQuestionHandler(base.BaseHandler):
+  cache_args = ('sort', 'pic')
+
   async def get(self, id):
     if id.endswith(' '):
       raise web.HTTPError(404)
@@ -640,17 +729,19 @@ class ZhihuQuestionHandler(base.BaseHandler):
     pic = self.get_argument('pic', None)
 
     try:
-      rss = await question2rss(id, sort=sort, pic=pic)
+      rss = await question2rss(id, sort=sort, pic=pic,
+                               not_modified=self.not_modified)
     except web.HTTPError:
       self.set_header('Cache-Control', 'public, max-age=86400')
       raise
 
-    self.finish(rss)
+    if rss is not None:
+      await self.finish_feed(rss)
 
 async def test():
   # rss = await activities2rss('cai-qian-hua-56')
   rss = await activities2rss('farseerfc')
-  print(rss)
+  print(''.join(rss))
 
 if __name__ == '__main__':
   import tornado.ioloop
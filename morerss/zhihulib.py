@@ -1,82 +1,121 @@
 import logging
-import json
 from typing import Optional
 from urllib.parse import urlsplit, parse_qs
 import re
 import itertools
+import functools
 
 from tornado.options import options, define
-from tornado.httpclient import HTTPRequest
-from tornado import web, httpclient
+from tornado import web
 from lxml.html import fromstring, tostring
 
-from . import base, pycurl
-try:
-  from . import proxy
-except ImportError:
-  proxy = None
+from . import base, upstream, proxy, embedded, rewrite
 
-_httpclient = httpclient.AsyncHTTPClient()
 logger = logging.getLogger(__name__)
 re_zhihu_img = re.compile(r'https://\w+\.zhimg\.com/.+')
 
 define("zhihu-proxy", default=False,
-        help="use proxies for zhihu", type=bool)
+        help="use the proxies in --zhihu-proxy-file for zhihu", type=bool)
+define("zhihu-rate", default=2.0,
+       help="requests per second to each zhihu host when not using proxies, 0 for no limit", type=float)
+define("zhihu-burst", default=5,
+       help="requests that may be sent to a zhihu host at once after being idle", type=int)
+define("zhihu-max-active", default=4,
+       help="maximum requests in flight to each zhihu host", type=int)
+define("zhihu-max-queued", default=100,
+       help="maximum requests waiting for each zhihu host before answering 503", type=int)
+define("zhihu-max-wait", default=10.0,
+       help="seconds a request may wait for a zhihu host before answering 503", type=float)
+
+def _proxy_banned(res):
+  '''Whether zhihu has banned the proxy a response came through
+
+  Only the "unhuman" check counts; other 403s are for forbidden content.
+  '''
+  if res.code == 302:
+    return 'unhuman' in res.headers.get('Location', '')
+  elif res.code == 403:
+    return bool(res.body and b'unhuman' in res.body)
+  return False
+
+def _is_unhuman(res):
+  '''Whether zhihu is rate-limiting us, or failing'''
+  return _proxy_banned(res) or upstream.is_overloaded(res)
 
 class ZhihuManager:
   def __init__(self):
     # don't show GET xxx
-    if pycurl:
+    if upstream.pycurl:
       from tornado.curl_httpclient import curl_log
       curl_log.setLevel(logging.INFO)
+    self.site = upstream.Site('zhihu', headers={
+      'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0',
+    }, overloaded=_is_unhuman)
+    # host -> upstream.Limiter, for direct requests
+    self._limiters = {}
+
+  def _limiter(self, url):
+    host = urlsplit(url).hostname
+    limiter = self._limiters.get(host)
+    if limiter is None:
+      limiter = self._limiters[host] = upstream.Limiter(
+        host,
+        rate = options.zhihu_rate,
+        burst = options.zhihu_burst,
+        max_active = options.zhihu_max_active,
+        max_queued = options.zhihu_max_queued,
+        max_wait = options.zhihu_max_wait,
+      )
+    return limiter
 
-  async def _do_fetch(self, url, kwargs):
-    if proxy and options.zhihu_proxy:
-      return await self._do_fetch_with_proxy(url, kwargs)
+  async def _do_fetch(self, url, kwargs, ttl):
+    if options.zhihu_proxy:
+      return await self._do_fetch_with_proxy(url, kwargs, ttl)
     else:
-      return await self._do_fetch_direct(url, kwargs)
-
-  async def _do_fetch_direct(self, url, kwargs):
-    req = HTTPRequest(url, **kwargs)
-    res = await _httpclient.fetch(req, raise_error=False)
+      return await self._do_fetch_direct(url, kwargs, ttl)
+
+  async def _do_fetch_direct(self, url, kwargs, ttl):
+    req = self.site.request(url, **kwargs)
+    # only direct requests count for the breaker: when proxied, zhihu
+    # blocks the proxy rather than us
+    res = await upstream.fetch(
+      req, ttl=ttl, limiter=self._limiter(url),
+      pool=self.site.pool, breaker=self.site.breaker)
     return res
 
-  async def _do_fetch_with_proxy(self, url, kwargs):
-    async with proxy.get_proxy() as p:
-      host, port = p.rsplit(':', 1)
-
-      req = HTTPRequest(
-        url, proxy_host = host, proxy_port = int(port),
-        request_timeout = 10,
-        validate_cert = False,
-        **kwargs,
-      )
-
-      res = await _httpclient.fetch(req, raise_error=False)
-
-      if res.code == 302 and 'unhuman' in res.headers.get('Location'):
-        logger.warning('proxy %s is unhuman-ed by zhihu', p)
-        raise Exception('unhuman-ed proxy')
-      elif res.code == 403:
-        res.rethrow()
+  async def _do_fetch_with_proxy(self, url, kwargs, ttl):
+    req = self.site.request(
+      url,
+      request_timeout = 10,
+      validate_cert = False,
+      **kwargs,
+    )
+    # a proxy is picked only for requests that actually go out
+    res = await upstream.fetch(
+      req, ttl=ttl, pool=self.site.pool,
+      proxies=proxy.get_pool(_proxy_banned))
+    return res
 
-      return res
+  async def fetch_zhihu(self, url, *, ttl=None, negative_key=None, **kwargs):
+    '''Fetch *url* from zhihu, raising web.HTTPError for errors
 
-  async def fetch_zhihu(self, url, **kwargs):
+    Gone or forbidden resources are remembered by *negative_key*, e.g. for
+    URLs that change with every request, or by *url*.
+    '''
     if url.startswith('http://'):
       url = 'https://' + url[len('http://'):]
     kwargs.setdefault('follow_redirects', False)
-    kwargs.setdefault('user_agent', 'Mozilla/5.0 (X11; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0')
     kwargs.pop('raise_error', None)
+    key = negative_key or url
 
-    res = await self._do_fetch(url, kwargs)
+    upstream.check_negative(key)
+    res = await self._do_fetch(url, kwargs, ttl)
 
-    if res.code in [404, 429]:
-      raise web.HTTPError(res.code)
     # 410 in case only logged-in users can see
     # let's return 403 instead
     # 401: suspended account, e.g. hou-xiao-yu-8
-    elif res.code in [410, 401]:
+    if res.code in [410, 401]:
+      upstream.remember_negative(key, 403)
       raise web.HTTPError(403)
     elif res.code == 302:
       if 'unhuman' in res.headers.get('Location'):
@@ -87,12 +126,12 @@ class ZhihuManager:
     # HTTP 301 Moved Permanently
     elif res.code == 301:
       url = res.headers.get('Location')
-      res = await self._do_fetch(url, kwargs)
+      res = await self._do_fetch(url, kwargs, ttl)
     else:
-      if res.error:
+      if res.error and res.code != 404:
         logger.error('error fetching url: %s', url)
         # print(res.headers, res.body and res.body[:100])
-      res.rethrow()
+      upstream.raise_for_status(key, res)
 
     return res
 
@@ -100,89 +139,136 @@ fetch_zhihu = ZhihuManager().fetch_zhihu
 
 def process_content_for_html(body, pic):
   doc = fromstring(body)
-  tidy_content(doc)
-  if pic:
-    base.proxify_pic(doc, re_zhihu_img, pic)
+  doc = get_rewriter(tidy=True, pic=pic)(doc)
+  return tostring(doc, encoding=str)
+
+def proxify_content(body, pic):
+  '''*body* with zhihu pictures loaded via *pic*'''
+  doc = get_rewriter(pic=pic)(fromstring(body))
   return tostring(doc, encoding=str)
 
+def content_variants(body):
+  '''proxify_content() of *body* for each of base.PIC_PROXIES, by name'''
+  return {pic: proxify_content(body, pic) for pic in base.PIC_PROXIES}
+
 re_br_to_remove = re.compile(r'(?:<br>)+')
-re_img = re.compile(r'<img [^>]*?src="([^h])')
-re_zhihu_img = re.compile(r'https://\w+\.zhimg\.com/.+')
 
 _picN = iter(itertools.cycle('1234'))
 
-def _abs_img(m):
-  return '<img src="https://pic%s.zhimg.com/' % next(_picN) + m.group(1)
-
 def process_content_for_rss(body, pic):
+  # only literal "<br>"s go, so this can't be done on the tree
   body = re_br_to_remove.sub(r'', body)
-  body = re_img.sub(_abs_img, body)
-  body = body.replace('<img ', '<img referrerpolicy="no-referrer" ')
-  body = body.replace('<code ', '<pre><code ')
-  body = body.replace('</code>', '</code></pre>')
-
   doc = fromstring(body)
-  if pic:
-    base.proxify_pic(doc, re_zhihu_img, pic)
+  doc = get_rewriter(rss=True, code=True, pic=pic)(doc)
   return tostring(doc, encoding=str)
 
 async def fetch_article(id: str, pic: Optional[str],
                         processor=process_content_for_html):
   url = f'https://zhuanlan.zhihu.com/p/{id}'
   res = await fetch_zhihu(url)
-  page = res.body.decode('utf-8')
 
-  doc = fromstring(page)
   try:
-    static = doc.xpath('//script[@id="js-initialData"]')[0]
-  except IndexError:
-    logger.error('page source: %s', page)
+    content = embedded.script_json(
+      res.body, 'id', 'js-initialData')['initialState']
+  except ValueError:
+    logger.error('page source: %s', res.body.decode('utf-8', 'replace'))
     raise
-  content = json.loads(static.text)['initialState']
 
   article = content['entities']['articles'][id]
   article['content'] = processor(article['content'], pic=pic)
   return article
 
-def tidy_content(doc):
-  for br in doc.xpath('//p/following-sibling::br'):
-    br.getparent().remove(br)
+# Rules for rewrite.Rewriter; see get_rewriter()
 
-  for noscript in doc.xpath('//noscript'):
-    p = noscript.getparent()
-    img = noscript.getnext()
-    if img.tag == 'img':
-      p.remove(img)
-    p.replace(noscript, noscript[0])
-
-  for img in doc.xpath('//img[@src]'):
-    attrib = img.attrib
-    attrib['referrerpolicy'] = 'no-referrer'
-    if 'data-original' in attrib:
-      img.set('src', attrib['data-original'])
-      del attrib['data-original']
-
-    if 'class' in attrib:
-      del attrib['class']
-    if 'data-rawwidth' in attrib:
-      del attrib['data-rawwidth']
-    if 'data-rawheight' in attrib:
-      del attrib['data-rawheight']
-
-  for a in doc.xpath('//a[starts-with(@href, "https://link.zhihu.com/?target=")]'):
-    href = a.get('href')
-    href = parse_qs(urlsplit(href).query)['target'][0]
-    a.set('href', href)
+_zhihu_link = 'https://link.zhihu.com/?target='
 
-  for a in doc.xpath('//a[starts-with(@href, "https://link.zhihu.com/?target=")]'):
-    href = a.get('href')
-    href = parse_qs(urlsplit(href).query)['target'][0]
-    a.set('href', href)
+def _see_p(p, state):
+  state.setdefault('p_parents', set()).add(p.getparent())
+
+def _is_br_after_p(el, state):
+  # the <p>s before it have been seen already
+  return el.tag == 'br' and el.getparent() in state.get('p_parents', ())
 
-  for a in doc.xpath('//a'):
-    for k in ['rel', 'class']:
-      try:
-        del a.attrib[k]
-      except KeyError:
-        pass
+def _drop_br_after_p(br, state):
+  if _is_br_after_p(br, state):
+    br.getparent().remove(br)
 
+def _unwrap_noscript(noscript, state):
+  # the picture in it replaces the placeholder after it
+  img = noscript.getnext()
+  while img is not None and _is_br_after_p(img, state):
+    img = img.getnext()
+  p = noscript.getparent()
+  if img is not None and img.tag == 'img':
+    p.remove(img)
+  child = noscript[0]
+  p.replace(noscript, child)
+  return child
+
+def _tidy_img(img, state):
+  attrib = img.attrib
+  if 'src' not in attrib:
+    return
+  attrib['referrerpolicy'] = 'no-referrer'
+  if 'data-original' in attrib:
+    img.set('src', attrib['data-original'])
+    del attrib['data-original']
+  for k in ('class', 'data-rawwidth', 'data-rawheight'):
+    attrib.pop(k, None)
+
+def _tidy_link(a, state):
+  href = a.get('href')
+  while href is not None and href.startswith(_zhihu_link):
+    href = parse_qs(urlsplit(href).query)['target'][0]
+    a.set('href', href)
+  attrib = a.attrib
+  for k in ('rel', 'class'):
+    attrib.pop(k, None)
+
+def _rss_img(img, state):
+  src = img.get('src')
+  if src and not src.startswith('h'):
+    img.set('src', 'https://pic%s.zhimg.com/' % next(_picN) + src)
+  # referrerpolicy goes first
+  attrs = [(k, v) for k, v in img.items() if k != 'referrerpolicy']
+  img.attrib.clear()
+  img.set('referrerpolicy', 'no-referrer')
+  for k, v in attrs:
+    img.set(k, v)
+
+def _wrap_code(code, state):
+  # only code elements with attributes are wrapped, as they used to be
+  # by replacing "<code " in the source
+  if not len(code.attrib):
+    return
+  pre = code.makeelement('pre')
+  pre.tail, code.tail = code.tail, None
+  code.addprevious(pre)
+  pre.append(code)
+  return pre
+
+@functools.lru_cache()
+def get_rewriter(*, tidy=False, rss=False, code=False, pic=None):
+  '''A rewrite.Rewriter for zhihu content
+
+  tidy: clean up pictures and links of content from the API or pages
+  rss: make pictures absolute, for content in the old RSS format
+  code: wrap code blocks in <pre>
+  pic: load zhihu pictures via this one of base.PIC_PROXIES
+  '''
+  rules = []
+  if code:
+    rules.append(('code', _wrap_code))
+  if tidy:
+    rules.extend([
+      ('p', _see_p),
+      ('br', _drop_br_after_p),
+      ('noscript', _unwrap_noscript),
+      ('img', _tidy_img),
+      ('a', _tidy_link),
+    ])
+  if rss:
+    rules.append(('img', _rss_img))
+  if pic:
+    rules.append(('img', rewrite.proxify_rule(re_zhihu_img, pic)))
+  return rewrite.Rewriter(rules)
@@ -0,0 +1,121 @@
+'''Tests for the zhihu proxy pool, with fake proxies in place of send()'''
+
+import io
+import asyncio
+
+import pytest
+from tornado.httpclient import HTTPRequest, HTTPResponse
+from tornado.options import options
+
+from morerss import proxy, zhihulib
+
+class FakeProxies:
+  '''send() for ProxyPool.fetch(), answering for each proxy host as told
+
+  *behaviour* maps hosts to (seconds, code, body); a code of None raises.
+  '''
+  def __init__(self, behaviour):
+    self.behaviour = behaviour
+    self.sent = []
+
+  async def send(self, request):
+    self.sent.append(request.proxy_host)
+    delay, code, body = self.behaviour[request.proxy_host]
+    await asyncio.sleep(delay)
+    if code is None:
+      raise OSError('connection reset')
+    return HTTPResponse(request, code, buffer=io.BytesIO(body))
+
+UNHUMAN = b'<a href="https://www.zhihu.com/account/unhuman">'
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 0.0)
+  path = tmp_path / 'proxies'
+  path.write_text('a:1\nb:2  # comment\n')
+  return proxy.ProxyPool(str(path), zhihulib._proxy_banned)
+
+def fetch(pool, fake):
+  return asyncio.run(
+    pool.fetch(HTTPRequest('https://www.zhihu.com/'), fake.send))
+
+def test_load(pool):
+  assert sorted(pool.proxies) == ['a:1', 'b:2']
+  assert pool.proxies['b:2'].port == 2
+
+def test_scores(pool):
+  fake = FakeProxies({'a': (0, 200, b''), 'b': (0, 599, b'')})
+  for _ in range(20):
+    fetch(pool, fake)
+  a, b = pool.proxies['a:1'], pool.proxies['b:2']
+  assert a.failure == 0 and a.latency is not None
+  assert b.failure > 0.5 and b.latency is None
+  assert a.weight(1) > b.weight(1)
+  assert a.active == b.active == 0
+
+def test_ban_on_unhuman_only(pool):
+  fake = FakeProxies({'a': (0, 403, b'forbidden'), 'b': (0, 403, b'forbidden')})
+  res = fetch(pool, fake)
+  assert res.code == 403
+  assert len(pool.usable()) == 2
+
+  fake.behaviour = {'a': (0, 403, UNHUMAN), 'b': (0, 403, UNHUMAN)}
+  fetch(pool, fake)
+  banned, = [p for p in pool.proxies.values() if p.bans]
+  assert pool.usable() == [p for p in pool.proxies.values() if p is not banned]
+
+def test_ban_backoff(pool, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_quarantine', 10.0)
+  monkeypatch.setattr(options, 'zhihu_proxy_max_quarantine', 30.0)
+  p = pool.proxies['a:1']
+  quarantines = []
+  for _ in range(4):
+    pool.ban(p)
+    quarantines.append(round(p.quarantined_until - proxy.time.time()))
+  assert quarantines == [10, 20, 30, 30]
+
+def test_no_usable_proxy(pool):
+  for p in pool.proxies.values():
+    pool.ban(p)
+  with pytest.raises(proxy.web.HTTPError) as e:
+    fetch(pool, FakeProxies({}))
+  assert e.value.status_code == 503
+
+@pytest.fixture
+def in_order(monkeypatch):
+  '''Pick usable proxies in the order listed, a:1 then b:2'''
+  monkeypatch.setattr(
+    proxy.random, 'choices', lambda population, weights: population[:1])
+
+def test_hedge_faster_wins(pool, in_order, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 0.02)
+  fake = FakeProxies({'a': (0.2, 200, b'slow'), 'b': (0.01, 200, b'fast')})
+  res = fetch(pool, fake)
+  assert res.body == b'fast' and fake.sent == ['a', 'b']
+
+def test_no_hedge_when_fast(pool, in_order, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 0.05)
+  fake = FakeProxies({'a': (0, 200, b'fast'), 'b': (0, 200, b'')})
+  res = fetch(pool, fake)
+  assert res.body == b'fast' and fake.sent == ['a']
+
+def test_hedge_failure_loses(pool, in_order, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 0.02)
+  # a fails first, while b is still pending
+  fake = FakeProxies({'a': (0.05, 599, b''), 'b': (0.1, 200, b'good')})
+  res = fetch(pool, fake)
+  assert res.code == 200 and fake.sent == ['a', 'b']
+
+def test_hedge_all_failed(pool, in_order, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 0.02)
+  fake = FakeProxies({'a': (0.05, None, b''), 'b': (0.05, 599, b'')})
+  res = fetch(pool, fake)
+  # the response is preferred to the exception
+  assert res.code == 599 and fake.sent == ['a', 'b']
+
+def test_fast_failure_hedges_at_once(pool, in_order, monkeypatch):
+  monkeypatch.setattr(options, 'zhihu_proxy_hedge', 10.0)
+  fake = FakeProxies({'a': (0, 403, UNHUMAN), 'b': (0, 200, b'good')})
+  res = fetch(pool, fake)
+  assert res.code == 200 and fake.sent == ['a', 'b']
+  assert pool.proxies['a:1'].bans == 1
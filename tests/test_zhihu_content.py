@@ -0,0 +1,50 @@
+'''Golden tests for rewriting zhihu content.
+
+tests/fixtures/zhihu_content.json has pieces of zhihu content, each with
+what it is turned into for HTML, for RSS and for a zhihu_stream item with
+every picture proxy. Expected outputs are those of the XPath rewriting the
+one-walk Rewriter replaced; cases with a "changed" note differ from them
+on purpose.
+'''
+
+import os
+import json
+import itertools
+
+import pytest
+
+from morerss import zhihulib, zhihu_stream
+
+with open(os.path.join(os.path.dirname(__file__),
+                       'fixtures', 'zhihu_content.json')) as f:
+  CASES = json.load(f)
+
+PICS = [None, 'cf', 'google']
+
+def params():
+  return [pytest.param(case, pic, id='%s-%s' % (case['name'], pic))
+          for case in CASES for pic in PICS]
+
+@pytest.fixture(autouse=True)
+def pic_servers(monkeypatch):
+  # relative pictures are spread over pic1-pic4 in turn
+  monkeypatch.setattr(zhihulib, '_picN', iter(itertools.cycle('1234')))
+
+@pytest.mark.parametrize('case, pic', params())
+def test_html(case, pic):
+  out = zhihulib.process_content_for_html(case['content'], pic)
+  assert out == case['html'][pic or 'none']
+
+@pytest.mark.parametrize('case, pic', params())
+def test_rss(case, pic):
+  out = zhihulib.process_content_for_rss(case['content'], pic)
+  assert out == case['rss'][pic or 'none']
+
+@pytest.mark.parametrize('case, pic', params())
+def test_stream_item(case, pic):
+  post = {
+    'type': 'article', 'title': 't', 'id': 1, 'created': 0,
+    'author': {'name': 'a'}, 'content': case['content'],
+  }
+  item = zhihu_stream.post2rss(post, pic=pic)
+  assert item.description == case['stream'][pic or 'none']